@@ -1,13 +1,19 @@
 import streamlit as st
 import os
-import uuid
 from datetime import datetime, timedelta
-from PIL import Image
-import io
-import json
-import base64
-import sqlite3
 import shutil
+import tempfile
+
+from cache import RenderCache
+from database import DatabaseManager
+from expiry import ExpiryWorker
+from image_manager import ImageManager
+from imaging import (ImageTooLarge, check_limits, display_size, perceptual_hash, pick_derivative, preview_bytes,
+                     probe_image)
+from importer import ARCHIVE_EXTENSIONS, MAX_APP_ARCHIVE_BYTES, import_archive
+from locations import LocationIndex
+from signing import LinkSigner
+from worker import IN_PROCESS_WORKER, JobWorker
 
 # Page configuration
 st.set_page_config(
@@ -166,285 +172,103 @@ if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
 if 'username' not in st.session_state:
     st.session_state.username = ""
-if 'user_images' not in st.session_state:
-    st.session_state.user_images = []
+if 'gallery_cursors' not in st.session_state:
+    # Keyset cursors of the gallery pages visited so far; last one is current
+    st.session_state.gallery_cursors = [None]
+if 'export_selection' not in st.session_state:
+    # Filenames ticked for export, kept across gallery pages
+    st.session_state.export_selection = set()
+if 'similar_to' not in st.session_state:
+    # (image id, name) the gallery is showing look-alikes of, or None
+    st.session_state.similar_to = None
 
 # Create directories
 os.makedirs("user_images", exist_ok=True)
 os.makedirs("user_data", exist_ok=True)
 os.makedirs("static/media", exist_ok=True)
 
-class DatabaseManager:
-    def __init__(self):
-        self.db_file = "user_data/images.db"
-        self.init_database()
-    
-    def init_database(self):
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                original_name TEXT NOT NULL,
-                file_path TEXT NOT NULL,
-                media_path TEXT NOT NULL,
-                file_size INTEGER NOT NULL,
-                file_extension TEXT NOT NULL,
-                upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                delete_key TEXT UNIQUE,
-                auto_delete_hours INTEGER DEFAULT 0,
-                expires_at TIMESTAMP,
-                views INTEGER DEFAULT 0,
-                FOREIGN KEY (username) REFERENCES users (username)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-    
-    def register_user(self, username, password):
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password))
-            conn.commit()
-            return True, "Registration successful"
-        except sqlite3.IntegrityError:
-            return False, "Username already exists"
-        finally:
-            conn.close()
-    
-    def login_user(self, username, password):
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('SELECT password FROM users WHERE username = ?', (username,))
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result and result[0] == password:
-            return True, "Login successful"
-        return False, "Invalid credentials"
-    
-    def save_image(self, username, image_data):
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO images (username, filename, original_name, file_path, media_path, 
-                              file_size, file_extension, delete_key, auto_delete_hours, expires_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            username, image_data['filename'], image_data['original_name'],
-            image_data['file_path'], image_data['media_path'], image_data['file_size'],
-            image_data['file_extension'], image_data['delete_key'],
-            image_data['auto_delete_hours'], image_data['expires_at']
-        ))
-        
-        conn.commit()
-        conn.close()
-    
-    def get_user_images(self, username):
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM images 
-            WHERE username = ? 
-            ORDER BY upload_time DESC
-        ''', (username,))
-        
-        columns = [column[0] for column in cursor.description]
-        images = []
-        for row in cursor.fetchall():
-            image_data = dict(zip(columns, row))
-            images.append(image_data)
-        
-        conn.close()
-        return images
-    
-    def delete_image(self, username, filename):
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            DELETE FROM images WHERE username = ? AND filename = ?
-        ''', (username, filename))
-        
-        deleted = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return deleted
-    
-    def increment_views(self, filename):
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE images SET views = views + 1 WHERE filename = ?
-        ''', (filename,))
-        
-        conn.commit()
-        conn.close()
-    
-    def cleanup_expired_images(self):
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT filename, file_path, media_path FROM images 
-            WHERE expires_at IS NOT NULL AND expires_at < ?
-        ''', (datetime.now(),))
-        
-        expired_images = cursor.fetchall()
-        
-        for filename, file_path, media_path in expired_images:
-            # Delete files
-            for path in [file_path, media_path]:
-                if os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except:
-                        pass
-            
-            # Delete from database
-            cursor.execute('DELETE FROM images WHERE filename = ?', (filename,))
-        
-        conn.commit()
-        conn.close()
-        return len(expired_images)
+@st.cache_resource
+def get_database():
+    """Shared DatabaseManager, created once per server process"""
+    return DatabaseManager()
 
-class ImageManager:
-    def __init__(self):
-        self.base_path = "user_images"
-        self.media_path = "static/media"
-        self.db = DatabaseManager()
-    
-    def save_image(self, username, uploaded_file, auto_delete_hours=0):
-        user_dir = os.path.join(self.base_path, username)
-        os.makedirs(user_dir, exist_ok=True)
-        os.makedirs(self.media_path, exist_ok=True)
-        
-        file_extension = uploaded_file.name.split('.')[-1].lower()
-        unique_id = uuid.uuid4().hex[:16]
-        filename = f"{unique_id}.{file_extension}"
-        file_path = os.path.join(user_dir, filename)
-        media_path = os.path.join(self.media_path, filename)
-        
-        file_content = uploaded_file.getbuffer()
-        with open(file_path, "wb") as f:
-            f.write(file_content)
-        with open(media_path, "wb") as f:
-            f.write(file_content)
-        
-        expires_at = None
-        if auto_delete_hours > 0:
-            expires_at = datetime.now() + timedelta(hours=auto_delete_hours)
-        
-        image_data = {
-            'filename': filename,
-            'original_name': uploaded_file.name,
-            'file_path': file_path,
-            'media_path': media_path,
-            'file_size': len(file_content),
-            'file_extension': file_extension,
-            'delete_key': uuid.uuid4().hex[:12],
-            'auto_delete_hours': auto_delete_hours,
-            'expires_at': expires_at
-        }
-        
-        self.db.save_image(username, image_data)
-        return image_data
-    
-    def get_user_images(self, username):
-        return self.db.get_user_images(username)
-    
-    def delete_image(self, username, filename):
-        image_data = next((img for img in self.get_user_images(username) if img['filename'] == filename), None)
-        if image_data:
-            # Delete files
-            for path in [image_data['file_path'], image_data['media_path']]:
-                if os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except:
-                        pass
-            
-            # Delete from database
-            return self.db.delete_image(username, filename)
-        return False
-    
-    def get_image_url(self, image_data):
-        filename = image_data['filename']
-        
-        try:
-            # Try to get the current server information
-            from streamlit.web.server.server import Server
-            from streamlit.runtime.scriptrunner import get_script_run_ctx
-            
-            ctx = get_script_run_ctx()
-            if ctx and hasattr(ctx, 'host') and ctx.host:
-                base_url = f"http://{ctx.host}"
-                return f"{base_url}/media/{filename}"
-        except:
-            pass
-        
-        # Fallback for local development
-        return f"/media/{filename}"
-    
-    def format_file_size(self, size_bytes):
-        """Convert file size to human readable format"""
-        if size_bytes == 0:
-            return "0 B"
-        size_names = ["B", "KB", "MB", "GB"]
-        i = 0
-        while size_bytes >= 1024 and i < len(size_names)-1:
-            size_bytes /= 1024.0
-            i += 1
-        return f"{size_bytes:.1f} {size_names[i]}"
-    
-    def format_time_remaining(self, expires_at):
-        """Format time remaining until expiration"""
-        if not expires_at:
-            return "Never"
-        
-        if isinstance(expires_at, str):
-            expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-        
-        now = datetime.now()
-        if expires_at < now:
-            return "Expired"
-        
-        delta = expires_at - now
-        days = delta.days
-        hours = int(delta.seconds // 3600)
-        minutes = int((delta.seconds % 3600) // 60)
-        
-        if days > 0:
-            return f"{days}d {hours}h"
-        elif hours > 0:
-            return f"{hours}h {minutes}m"
-        else:
-            return f"{minutes}m"
+@st.cache_resource
+def start_expiry_worker():
+    """Background expiry deletion; one per server process, one active per deployment"""
+    worker = ExpiryWorker(get_database())
+    worker.start()
+    return worker
+
+@st.cache_resource
+def start_job_worker():
+    """Thumbnail/preview jobs for this server process, unless worker.py handles them"""
+    if not IN_PROCESS_WORKER:
+        return None
+    worker = JobWorker(get_database())
+    worker.start()
+    return worker
+
+@st.cache_resource
+def get_render_cache():
+    """Gallery query results, thumbnail bytes and card HTML shared by this process's sessions"""
+    return RenderCache()
+
+@st.cache_resource
+def get_location_index():
+    """Filename -> location index shared by this process's sessions, warmed once"""
+    locations = LocationIndex(get_database())
+    locations.warm()
+    return locations
+
+@st.cache_resource
+def get_link_signer():
+    """Share-link signing keys, loaded once per server process"""
+    return LinkSigner()
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def upload_preview(file_id, _uploaded_file):
+    """Thumbnail, header metadata and any rejection reason for a selected file, computed once per upload"""
+    metadata = None
+    try:
+        metadata = probe_image(_uploaded_file)
+        check_limits(metadata)
+        _uploaded_file.seek(0)
+        thumbnail = preview_bytes(_uploaded_file)
+        _uploaded_file.seek(0)
+        metadata['phash'] = perceptual_hash(_uploaded_file)
+        return thumbnail, metadata, None
+    except ImageTooLarge as e:
+        return None, metadata, str(e)
+    except Exception:
+        return None, None, None
+    finally:
+        _uploaded_file.seek(0)
+
+# Widest a gallery card's image renders in the 3-column wide layout
+GALLERY_COLUMN_WIDTH = 440
+
+def toggle_export_selection(filename):
+    if st.session_state[f"select_{filename}"]:
+        st.session_state.export_selection.add(filename)
+    else:
+        st.session_state.export_selection.discard(filename)
 
-def get_binary_file_downloader_html(file_path, filename, button_text):
-    with open(file_path, 'rb') as f:
-        data = f.read()
-    b64 = base64.b64encode(data).decode()
-    href = f'<a href="data:application/octet-stream;base64,{b64}" download="{filename}" style="text-decoration: none; flex: 1;"><button class="download-button">{button_text}</button></a>'
+def get_download_link_html(download_url, button_text):
+    # Served by media_server.py, so the page only carries a link
+    href = f'<a href="{download_url}" style="text-decoration: none; flex: 1;"><button class="download-button">{button_text}</button></a>'
     return href
 
+def get_card_buttons_html(image_url, download_url, filename, slot):
+    return f"""
+    <div class="button-container">
+        <button class="copy-button" onclick="copyToClipboard('{image_url}', 'copy_msg_{slot}')">📋 Copy URL</button>
+        {get_download_link_html(download_url, "⬇️ Download")}
+        <button class="delete-button" onclick="confirmDelete('{filename}', 'delete_msg_{slot}')">🗑️ Delete</button>
+    </div>
+    <div id="copy_msg_{slot}" style="color: green; font-size: 0.9em; margin-top: 5px; display: none;">✅ Copied!</div>
+    <div id="delete_msg_{slot}" style="color: red; font-size: 0.9em; margin-top: 5px; display: none;"></div>
+    """
+
 def add_javascript():
     st.markdown("""
     <script>
@@ -492,7 +316,7 @@ def login_section():
             
             if st.button("🚀 Login to Dashboard", key="login_btn", use_container_width=True):
                 if login_username and login_password:
-                    db = DatabaseManager()
+                    db = get_database()
                     success, message = db.login_user(login_username, login_password)
                     if success:
                         st.session_state.logged_in = True
@@ -519,7 +343,7 @@ def login_section():
                     elif len(reg_password) < 6:
                         st.error("❌ Password must be at least 6 characters long!")
                     else:
-                        db = DatabaseManager()
+                        db = get_database()
                         success, message = db.register_user(reg_username, reg_password)
                         if success:
                             st.success("🎉 " + message + " You can now login!")
@@ -553,12 +377,9 @@ def login_section():
 
 def main_app():
     add_javascript()
-    image_manager = ImageManager()
-    
-    # Clean up expired images on app load
-    expired_count = image_manager.db.cleanup_expired_images()
-    if expired_count > 0:
-        st.sidebar.info(f"🧹 Cleaned up {expired_count} expired images")
+    image_manager = ImageManager(get_database(), locations=get_location_index(), signer=get_link_signer())
+    start_expiry_worker()
+    job_worker = start_job_worker()
     
     with st.sidebar:
         st.markdown(f"""
@@ -571,19 +392,16 @@ def main_app():
         st.markdown("---")
         st.subheader("📊 Dashboard Stats")
         
-        user_images = image_manager.get_user_images(st.session_state.username)
+        stats = image_manager.get_user_stats(st.session_state.username)
         
         col1, col2 = st.columns(2)
         with col1:
-            st.metric("Total Images", len(user_images))
+            st.metric("Total Images", stats['total_images'])
         with col2:
-            total_size = sum(img['file_size'] for img in user_images)
-            st.metric("Storage Used", image_manager.format_file_size(total_size))
+            st.metric("Storage Used", image_manager.format_file_size(stats['total_size']))
         
-        if user_images:
-            expiring_soon = sum(1 for img in user_images if img.get('expires_at') and 
-                               datetime.fromisoformat(img['expires_at'].replace('Z', '+00:00')) > datetime.now())
-            st.metric("Active Images", expiring_soon)
+        if stats['total_images']:
+            st.metric("Active Images", stats['active_images'])
         
         st.markdown("---")
         st.subheader("⚡ Quick Actions")
@@ -599,6 +417,9 @@ def main_app():
         if st.button("🚪 Logout", use_container_width=True):
             st.session_state.logged_in = False
             st.session_state.username = ""
+            st.session_state.gallery_cursors = [None]
+            st.session_state.export_selection = set()
+            st.session_state.similar_to = None
             st.rerun()
     
     # Main content area
@@ -607,9 +428,118 @@ def main_app():
     with tab1:
         st.title("🎨 Your Image Gallery")
         
-        user_images = image_manager.get_user_images(st.session_state.username)
+        search_text = st.text_input("🔍 Search", placeholder="Search by file name...", key="gallery_search")
+        with st.expander("Filters"):
+            filter_col1, filter_col2 = st.columns(2)
+            with filter_col1:
+                upload_range = st.date_input("📅 Uploaded between", value=(), key="gallery_dates")
+                extension_options = {
+                    "JPG": ["jpg", "jpeg"],
+                    "PNG": ["png"],
+                    "GIF": ["gif"],
+                    "BMP": ["bmp"],
+                    "WEBP": ["webp"]
+                }
+                selected_types = st.multiselect("🖼️ File types", options=list(extension_options.keys()))
+            with filter_col2:
+                min_mb = st.number_input("💾 Min size (MB)", min_value=0.0, value=0.0, step=0.5)
+                max_mb = st.number_input("💾 Max size (MB, 0 = no limit)", min_value=0.0, value=0.0, step=0.5)
+                expiry_options = {
+                    "Any": None,
+                    "Auto-deleting": True,
+                    "Permanent": False
+                }
+                selected_expiry = st.selectbox("⏰ Auto-delete", options=list(expiry_options.keys()))
+        
+        search = {}
+        if search_text.strip():
+            search['text'] = search_text.strip()
+        if len(upload_range) == 2:
+            search['uploaded_from'] = datetime.combine(upload_range[0], datetime.min.time())
+            search['uploaded_to'] = datetime.combine(upload_range[1] + timedelta(days=1), datetime.min.time())
+        if selected_types:
+            search['extensions'] = [ext for label in selected_types for ext in extension_options[label]]
+        if min_mb > 0:
+            search['min_size'] = int(min_mb * 1024 * 1024)
+        if max_mb > 0:
+            search['max_size'] = int(max_mb * 1024 * 1024)
+        if expiry_options[selected_expiry] is not None:
+            search['expiring'] = expiry_options[selected_expiry]
+        search_key = tuple(sorted((name, str(value)) for name, value in search.items()))
+        if st.session_state.get('gallery_search_key') != search_key:
+            # New criteria start again from the first page
+            st.session_state.gallery_search_key = search_key
+            st.session_state.gallery_cursors = [None]
+        
+        link_ttl_options = {
+            "When the image does": None,
+            "1 Hour": 3600,
+            "1 Day": 86400,
+            "1 Week": 604800
+        }
+        selected_link_ttl = st.selectbox(
+            "🔗 Shared links expire:",
+            options=list(link_ttl_options.keys()),
+            index=0
+        )
+        link_ttl = link_ttl_options[selected_link_ttl]
+        
+        # Exports stream from the media server, so they never tie up this process
+        selection = st.session_state.export_selection
+        export_col1, export_col2, export_col3 = st.columns([1, 1, 1])
+        with export_col1:
+            export_selected = st.button(f"📦 Export Selected ({len(selection)})", disabled=not selection, use_container_width=True)
+        with export_col2:
+            export_all = st.button("📦 Export All", disabled=stats['total_images'] == 0, use_container_width=True)
+        with export_col3:
+            if st.button("Clear Selection", disabled=not selection, use_container_width=True):
+                selection.clear()
+                st.rerun()
+        if export_selected or export_all:
+            export_url = image_manager.create_export(
+                st.session_state.username,
+                sorted(selection) if export_selected else None
+            )
+            st.markdown(get_download_link_html(export_url, "⬇️ Download ZIP (link valid for 24 hours)"), unsafe_allow_html=True)
+        
+        similar_to = st.session_state.similar_to
+        if similar_to:
+            similar_col1, similar_col2 = st.columns([3, 1])
+            with similar_col1:
+                st.info(f"🧬 Showing images that look like **{similar_to[1]}**, closest first")
+            with similar_col2:
+                if st.button("Show all images", use_container_width=True):
+                    st.session_state.similar_to = None
+                    st.rerun()
+        
+        cursors = st.session_state.gallery_cursors
+        render_cache = get_render_cache()
+        
+        def load_page():
+            if similar_to:
+                images, cursor = image_manager.find_similar_images(st.session_state.username, similar_to[0]), None
+            elif search:
+                images, cursor = image_manager.search_images(st.session_state.username, cursors[-1], **search)
+            else:
+                images, cursor = image_manager.get_user_images_page(st.session_state.username, cursors[-1])
+            image_ids = [img['id'] for img in images]
+            return (images, cursor, image_manager.get_derivatives(image_ids),
+                    image_manager.get_processing_images(image_ids))
+        
+        # data_version moves on every upload/delete/expiry and finished job, in any process
+        page_key = (st.session_state.username, stats['data_version'], similar_to or search_key, cursors[-1])
+        user_images, next_cursor, derivatives, processing = render_cache.pages.get_or_compute(page_key, load_page)
+        
+        if not user_images and len(cursors) > 1:
+            # The page emptied out (deletes/expiry); step back a page
+            cursors.pop()
+            st.rerun()
         
-        if not user_images:
+        if not user_images and similar_to:
+            st.info("🧬 No other images look like this one.")
+        elif not user_images and search:
+            st.info("🔍 No images match your search.")
+        elif not user_images:
             col1, col2, col3 = st.columns([1, 2, 1])
             with col2:
                 st.markdown("""
@@ -629,10 +559,20 @@ def main_app():
                             with st.container():
                                 st.markdown("<div class='image-card'>", unsafe_allow_html=True)
                                 
-                                # Display image
+                                # Display image; animations only ever show their still poster/thumbnail
                                 try:
-                                    image = Image.open(img_data['file_path'])
-                                    st.image(image, use_container_width=True, caption=img_data['original_name'])
+                                    preview = pick_derivative(derivatives[img_data['id']], GALLERY_COLUMN_WIDTH)
+                                    if preview:
+                                        st.image(render_cache.read_file(preview['path']), use_container_width=True, caption=img_data['original_name'])
+                                    elif img_data['id'] in processing:
+                                        st.info("⏳ Generating preview...")
+                                    else:
+                                        # Never hand the original to st.image: it would decode at full size
+                                        fallback = render_cache.thumbnails.get_or_compute(
+                                            (img_data['file_path'], GALLERY_COLUMN_WIDTH),
+                                            lambda: preview_bytes(img_data['file_path'], GALLERY_COLUMN_WIDTH)
+                                        )
+                                        st.image(fallback, use_container_width=True, caption=img_data['original_name'])
                                 except Exception as e:
                                     st.error(f"❌ Error loading image")
                                 
@@ -640,7 +580,22 @@ def main_app():
                                 st.caption(f"**{img_data['original_name']}**")
                                 st.caption(f"📅 {img_data['upload_time'][:16]}")
                                 st.caption(f"💾 {image_manager.format_file_size(img_data['file_size'])}")
+                                if img_data.get('width'):
+                                    width, height = display_size(img_data['width'], img_data['height'], img_data['orientation'])
+                                    st.caption(f"📐 {width}×{height} {img_data['image_format']}")
+                                if (img_data.get('frame_count') or 1) > 1:
+                                    duration = f" · {img_data['duration_ms'] / 1000:.1f}s" if img_data.get('duration_ms') else ""
+                                    st.caption(f"🎞️ Animated · {img_data['frame_count']} frames{duration}")
                                 st.caption(f"👁️ {img_data.get('views', 0)} views")
+                                if 'distance' in img_data:
+                                    st.caption(f"🧬 {img_data['distance']} of 64 bits apart")
+                                st.checkbox(
+                                    "Select for export",
+                                    value=img_data['filename'] in selection,
+                                    key=f"select_{img_data['filename']}",
+                                    on_change=toggle_export_selection,
+                                    args=(img_data['filename'],)
+                                )
                                 
                                 # Auto-delete info
                                 if img_data.get('expires_at'):
@@ -649,29 +604,27 @@ def main_app():
                                         st.markdown(f"<div class='expiry-badge'>⏰ {time_remaining}</div>", unsafe_allow_html=True)
                                 
                                 # Image URL
-                                image_url = image_manager.get_image_url(img_data)
+                                image_url = image_manager.get_image_url(img_data, link_ttl)
                                 st.markdown("**Shareable URL:**")
                                 st.markdown(f'<div class="url-display">{image_url}</div>', unsafe_allow_html=True)
                                 
                                 # Action buttons
-                                download_html = get_binary_file_downloader_html(
-                                    img_data['file_path'], 
-                                    img_data['original_name'],
-                                    "⬇️ Download"
+                                button_html = render_cache.fragments.get_or_compute(
+                                    (img_data['filename'], i + j, image_url),
+                                    lambda: get_card_buttons_html(
+                                        image_url,
+                                        image_manager.get_download_url(img_data, link_ttl),
+                                        img_data['filename'],
+                                        i + j
+                                    )
                                 )
-                                
-                                button_html = f"""
-                                <div class="button-container">
-                                    <button class="copy-button" onclick="copyToClipboard('{image_url}', 'copy_msg_{i+j}')">📋 Copy URL</button>
-                                    {download_html}
-                                    <button class="delete-button" onclick="confirmDelete('{img_data['filename']}', 'delete_msg_{i+j}')">🗑️ Delete</button>
-                                </div>
-                                <div id="copy_msg_{i+j}" style="color: green; font-size: 0.9em; margin-top: 5px; display: none;">✅ Copied!</div>
-                                <div id="delete_msg_{i+j}" style="color: red; font-size: 0.9em; margin-top: 5px; display: none;"></div>
-                                """
-                                
                                 st.markdown(button_html, unsafe_allow_html=True)
                                 
+                                if st.button("🧬 Find similar", key=f"similar_{img_data['filename']}", use_container_width=True):
+                                    st.session_state.similar_to = (img_data['id'], img_data['original_name'])
+                                    st.session_state.gallery_cursors = [None]
+                                    st.rerun()
+                                
                                 # Handle delete action
                                 if st.button(f"Delete {img_data['filename']}", key=f"delete_{img_data['filename']}", help="Delete this image", use_container_width=True):
                                     if image_manager.delete_image(st.session_state.username, img_data['filename']):
@@ -679,6 +632,19 @@ def main_app():
                                         st.rerun()
                                 
                                 st.markdown("</div>", unsafe_allow_html=True)
+            
+            # Page navigation
+            nav_prev, nav_page, nav_next = st.columns([1, 2, 1])
+            with nav_prev:
+                if st.button("⬅️ Newer", disabled=len(cursors) == 1, use_container_width=True):
+                    cursors.pop()
+                    st.rerun()
+            with nav_page:
+                st.markdown(f"<p style='text-align: center; color: white;'>Page {len(cursors)}</p>", unsafe_allow_html=True)
+            with nav_next:
+                if st.button("Older ➡️", disabled=next_cursor is None, use_container_width=True):
+                    cursors.append(next_cursor)
+                    st.rerun()
     
     with tab2:
         st.title("🚀 Upload New Images")
@@ -697,18 +663,29 @@ def main_app():
             
             if uploaded_files:
                 st.subheader(f"📁 Selected Files ({len(uploaded_files)})")
+                warn_duplicates = st.checkbox("Warn me about images I already have", value=True)
                 
                 for uploaded_file in uploaded_files:
+                    thumbnail, metadata, rejected = upload_preview(uploaded_file.file_id, uploaded_file)
                     col_a, col_b = st.columns([1, 3])
                     with col_a:
-                        try:
-                            image = Image.open(uploaded_file)
-                            st.image(image, width=80)
-                        except:
+                        if thumbnail:
+                            st.image(thumbnail, width=80)
+                        else:
                             st.error("❌")
                     with col_b:
                         st.write(f"**{uploaded_file.name}**")
-                        st.write(f"Size: {image_manager.format_file_size(len(uploaded_file.getbuffer()))}")
+                        st.write(f"Size: {image_manager.format_file_size(uploaded_file.size)}")
+                        if metadata:
+                            width, height = display_size(metadata['width'], metadata['height'], metadata['orientation'])
+                            st.write(f"Dimensions: {width}×{height} {metadata['image_format']}")
+                        if rejected:
+                            st.warning(f"Too large to upload: {rejected}")
+                        if warn_duplicates and metadata and metadata.get('phash') is not None:
+                            duplicates = image_manager.find_duplicates(st.session_state.username, metadata['phash'])
+                            if duplicates:
+                                names = ", ".join(d['original_name'] for d in duplicates)
+                                st.warning(f"Looks like an image you already have: {names}")
             
             st.markdown("</div>", unsafe_allow_html=True)
         
@@ -741,26 +718,71 @@ def main_app():
             if st.button("🚀 Upload All Images", type="primary", use_container_width=True, disabled=not uploaded_files):
                 if uploaded_files:
                     progress_bar = st.progress(0)
-                    success_count = 0
                     
-                    for i, uploaded_file in enumerate(uploaded_files):
-                        try:
-                            image_data = image_manager.save_image(
-                                st.session_state.username, 
-                                uploaded_file, 
-                                auto_delete_hours
-                            )
-                            success_count += 1
-                        except Exception as e:
-                            st.error(f"Failed to upload {uploaded_file.name}: {str(e)}")
-                        
-                        progress_bar.progress((i + 1) / len(uploaded_files))
+                    saved, failed = image_manager.save_images(
+                        st.session_state.username,
+                        uploaded_files,
+                        auto_delete_hours,
+                        progress_callback=progress_bar.progress
+                    )
+                    for name, error in failed:
+                        st.error(f"Failed to upload {name}: {str(error)}")
+                    if saved and job_worker:
+                        job_worker.notify()
                     
+                    success_count = len(saved)
                     if success_count > 0:
                         st.success(f"🎉 Successfully uploaded {success_count} image(s)!")
                         st.balloons()
                         st.rerun()
             
+            st.markdown("---")
+            st.subheader("📦 Import an Archive")
+            archive_file = st.file_uploader(
+                "ZIP or TAR of images",
+                type=list(ARCHIVE_EXTENSIONS),
+                key="archive_uploader"
+            )
+            st.caption(f"Up to {image_manager.format_file_size(MAX_APP_ARCHIVE_BYTES)}. Interrupted imports resume "
+                       "when the same archive is imported again.")
+            too_large = archive_file is not None and archive_file.size > MAX_APP_ARCHIVE_BYTES
+            if too_large:
+                st.error(f"❌ This archive is {image_manager.format_file_size(archive_file.size)}. Import large albums "
+                         f"on the server with `python manage.py import-archive {st.session_state.username} ARCHIVE`.")
+            
+            if st.button("📦 Import Archive", use_container_width=True, disabled=archive_file is None or too_large):
+                status = st.empty()
+                errors = []
+                
+                def report(record):
+                    status.info(f"📦 {record['imported']} imported, {record['failed']} skipped so far...")
+                
+                # Stream the upload to disk so entries can be read one at a time
+                with tempfile.NamedTemporaryFile(suffix=f"_{archive_file.name}", delete=False) as spooled:
+                    archive_file.seek(0)
+                    shutil.copyfileobj(archive_file, spooled)
+                try:
+                    record = import_archive(
+                        image_manager,
+                        st.session_state.username,
+                        spooled.name,
+                        archive_name=archive_file.name,
+                        auto_delete_hours=auto_delete_hours,
+                        progress_callback=report,
+                        error_callback=lambda name, error: errors.append((name, error))
+                    )
+                except ValueError as e:
+                    st.error(f"❌ {str(e)}")
+                else:
+                    for name, error in errors[:10]:
+                        st.error(f"Failed to import {name}: {str(error)}")
+                    if len(errors) > 10:
+                        st.error(f"...and {len(errors) - 10} more")
+                    status.success(f"🎉 Imported {record['imported']} image(s) from {record['archive_name']}"
+                                   f" ({record['failed']} skipped)")
+                finally:
+                    os.remove(spooled.name)
+            
             st.markdown("</div>", unsafe_allow_html=True)
 
 # Main app logic
@@ -0,0 +1,103 @@
+"""Query latency on the images table before and after the v2 index migration.
+
+Usage: python benchmarks/bench_indexes.py [--rows 1000000] [--users 1000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import MIGRATIONS, DatabaseManager, get_pool
+
+
+def populate(conn, rows, users):
+    now = datetime.now()
+    batch = []
+    for i in range(rows):
+        name = uuid.uuid4().hex[:16]
+        filename = f"{name}.jpg"
+        expires_at = now + timedelta(hours=random.randint(-48, 168)) if i % 4 == 0 else None
+        batch.append((
+            f"user{i % users}", filename, f"photo_{i}.jpg",
+            f"user_images/user{i % users}/{filename}", f"static/media/{filename}",
+            random.randint(10_000, 5_000_000), "jpg", uuid.uuid4().hex[:12],
+            (now - timedelta(seconds=rows - i)).strftime("%Y-%m-%d %H:%M:%S"),
+            expires_at,
+        ))
+        if len(batch) == 50_000:
+            insert(conn, batch)
+            batch = []
+    if batch:
+        insert(conn, batch)
+
+
+def insert(conn, batch):
+    conn.execute("BEGIN")
+    conn.executemany('''
+        INSERT INTO images (username, filename, original_name, file_path, media_path,
+                            file_size, file_extension, delete_key, upload_time, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', batch)
+    conn.execute("COMMIT")
+
+
+def timed(conn, sql, params, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(sql, params).fetchall()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def run_queries(conn, users, repeat):
+    filename = conn.execute("SELECT filename FROM images ORDER BY random() LIMIT 1").fetchone()[0]
+    queries = {
+        "get_user_images": ('''
+            SELECT * FROM images WHERE username = ? ORDER BY upload_time DESC
+        ''', (f"user{users // 2}",)),
+        "lookup by filename": ('''
+            SELECT views FROM images WHERE filename = ?
+        ''', (filename,)),
+        "expired sweep": ('''
+            SELECT filename, file_path, media_path FROM images
+            WHERE expires_at IS NOT NULL AND expires_at < ?
+        ''', (datetime.now() - timedelta(hours=47),)),
+    }
+    return {name: timed(conn, sql, params, repeat) for name, (sql, params) in queries.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "images.db")
+        conn = get_pool(db_file).connection()
+
+        # Start from a pre-index (v1) database, like existing deployments
+        MIGRATIONS[0](conn)
+        conn.execute("PRAGMA user_version = 1")
+        print(f"Populating {args.rows:,} rows for {args.users:,} users...")
+        populate(conn, args.rows, args.users)
+
+        before = run_queries(conn, args.users, args.repeat)
+        start = time.perf_counter()
+        DatabaseManager(db_file)
+        print(f"Migrations applied in {time.perf_counter() - start:.1f}s")
+        after = run_queries(conn, args.users, args.repeat)
+
+    print(f"{'query':<20}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    for name in before:
+        print(f"{name:<20}{before[name]:>14.2f}{after[name]:>14.2f}{before[name] / max(after[name], 1e-6):>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Load test for a running media server.
+
+Usage: python benchmarks/bench_media_server.py --url http://localhost:8502/media/<filename>
+       [--concurrency 64] [--duration 10] [--range 0-65535] [--etag '"..."']
+
+Opens ``--concurrency`` keep-alive connections and issues GETs back to back
+for ``--duration`` seconds, then reports throughput and latency percentiles.
+Uses only the standard library so it runs anywhere the app does.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return status, length
+
+
+async def client(url, headers, deadline, latencies, statuses, counters):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    request = (f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+               + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n").encode()
+    try:
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, length = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            statuses[status] += 1
+            counters["bytes"] += length
+    finally:
+        writer.close()
+
+
+async def run(args):
+    headers = {}
+    if args.range:
+        headers["Range"] = f"bytes={args.range}"
+    if args.etag:
+        headers["If-None-Match"] = args.etag
+    latencies, statuses, counters = [], Counter(), Counter()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    results = await asyncio.gather(
+        *(client(args.url, headers, deadline, latencies, statuses, counters) for _ in range(args.concurrency)),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - started
+    errors = [r for r in results if isinstance(r, Exception)]
+
+    if not latencies:
+        print(f"No successful requests ({len(errors)} connection errors)")
+        return
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{len(latencies)} requests in {elapsed:.1f}s: {len(latencies) / elapsed:,.0f} req/s, "
+          f"{counters['bytes'] / elapsed / 1024 / 1024:,.1f} MB/s")
+    print(f"latency ms: p50 {quantiles[49] * 1000:.2f}  p90 {quantiles[89] * 1000:.2f}  "
+          f"p99 {quantiles[98] * 1000:.2f}  max {max(latencies) * 1000:.2f}")
+    print("status codes:", dict(statuses), f"({len(errors)} connection errors)" if errors else "")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", required=True)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--range", help="Byte range to request, e.g. 0-65535")
+    parser.add_argument("--etag", help="Send as If-None-Match to measure 304 responses")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
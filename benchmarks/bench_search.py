@@ -0,0 +1,102 @@
+"""Gallery search latency (DatabaseManager.search_images) on a large table.
+
+Usage: python benchmarks/bench_search.py [--rows 1000000] [--users 100]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DatabaseManager, _migrate_image_search, get_pool
+
+WORDS = ("beach", "sunset", "family", "birthday", "mountain", "holiday", "screenshot",
+         "wedding", "garden", "concert", "city", "snow", "dog", "cat", "receipt", "scan")
+EXTENSIONS = ("jpg", "jpeg", "png", "gif", "webp")
+
+
+def populate(conn, rows, users):
+    now = datetime.now()
+    batch = []
+    for i in range(rows):
+        name = uuid.uuid4().hex[:16]
+        extension = random.choice(EXTENSIONS)
+        words = "_".join(random.sample(WORDS, 2))
+        batch.append((
+            f"user{i % users}", f"{name}.{extension}", f"{words}_{i}.{extension}",
+            f"static/media/{name}.{extension}", f"static/media/{name}.{extension}",
+            random.randint(10_000, 5_000_000), extension, uuid.uuid4().hex[:12],
+            (now - timedelta(seconds=rows - i)).strftime("%Y-%m-%d %H:%M:%S"),
+            now + timedelta(hours=random.randint(1, 168)) if i % 4 == 0 else None,
+        ))
+        if len(batch) == 50_000:
+            insert(conn, batch)
+            batch = []
+    if batch:
+        insert(conn, batch)
+
+
+def insert(conn, batch):
+    conn.execute("BEGIN")
+    conn.executemany('''
+        INSERT INTO images (username, filename, original_name, file_path, media_path,
+                            file_size, file_extension, delete_key, upload_time, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', batch)
+    conn.execute("COMMIT")
+
+
+def timed(db, repeat, **search):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        images, cursor = db.search_images("user0", **search)
+        if cursor:
+            db.search_images("user0", after_cursor=cursor, **search)
+    return (time.perf_counter() - start) / repeat / 2 * 1000, len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "images.db")
+        db = DatabaseManager(db_file)
+        conn = get_pool(db_file).connection()
+        # Insert straight into images on the current schema, then build the
+        # search index the way its migration does
+        print(f"Populating {args.rows:,} rows for {args.users:,} users...")
+        populate(conn, args.rows, args.users)
+        start = time.perf_counter()
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM images_fts")
+        _migrate_image_search(conn)
+        conn.execute("COMMIT")
+        print(f"Search index built in {time.perf_counter() - start:.1f}s")
+
+        month_ago = datetime.now() - timedelta(seconds=args.rows // 2)
+        searches = {
+            "one word": dict(text="sunset"),
+            "two word prefix": dict(text="sun wed"),
+            "rare word + number": dict(text="beach 4242"),
+            "date range": dict(uploaded_from=month_ago),
+            "size + extension": dict(min_size=4_000_000, extensions=["png"]),
+            "text + all filters": dict(text="dog", uploaded_from=month_ago, min_size=1_000_000,
+                                       extensions=["jpg", "jpeg"], expiring=False),
+        }
+        print(f"{'search':<22}{'ms/page':>10}{'results':>10}")
+        for name, search in searches.items():
+            ms, count = timed(db, args.repeat, **search)
+            print(f"{name:<22}{ms:>10.2f}{count:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Near-duplicate lookup latency (DatabaseManager.find_similar) on a large library.
+
+Usage: python benchmarks/bench_similar.py [--rows 1000000] [--users 1]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DatabaseManager, get_pool
+from similarity import DUPLICATE_DISTANCE, SIMILAR_DISTANCE, hash_chunks, to_signed
+
+
+def flip(value, bits):
+    for bit in random.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+def populate(conn, rows, users):
+    # A fifth of the library are re-uploads of a few thousand photos
+    originals = [random.getrandbits(64) for _ in range(max(rows // 500, 1))]
+    batch = []
+    for i in range(1, rows + 1):
+        if i % 5 == 0:
+            phash = flip(random.choice(originals), random.randint(0, 6))
+        else:
+            phash = random.getrandbits(64)
+        batch.extend((f"user{i % users}", chunk, value, i, to_signed(phash))
+                     for chunk, value in enumerate(hash_chunks(phash)))
+        if len(batch) >= 200_000:
+            insert(conn, batch)
+            batch = []
+    if batch:
+        insert(conn, batch)
+    return originals
+
+
+def insert(conn, batch):
+    conn.execute("BEGIN")
+    conn.executemany('''
+        INSERT INTO image_hash_chunks (username, chunk, value, image_id, phash) VALUES (?, ?, ?, ?, ?)
+    ''', batch)
+    conn.execute("COMMIT")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "images.db")
+        db = DatabaseManager(db_file)
+        print(f"Populating {args.rows:,} hashes for {args.users:,} users...")
+        originals = populate(get_pool(db_file).connection(), args.rows, args.users)
+
+        print(f"{'lookup':<26}{'ms/query':>10}{'matches':>10}")
+        for name, distance, near in (
+            ("duplicate, re-upload", DUPLICATE_DISTANCE, True),
+            ("duplicate, new photo", DUPLICATE_DISTANCE, False),
+            ("similar, re-upload", SIMILAR_DISTANCE, True),
+            ("similar, new photo", SIMILAR_DISTANCE, False),
+        ):
+            matches = 0
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                query = flip(random.choice(originals), 2) if near else random.getrandbits(64)
+                matches += len(db.find_similar(f"user{random.randrange(args.users)}", query, distance))
+            ms = (time.perf_counter() - start) / args.repeat * 1000
+            print(f"{name:<26}{ms:>10.2f}{matches / args.repeat:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Byte-bounded LRU caches for the render path.
+
+Entries are keyed by values that change whenever the underlying data does
+(e.g. a user's ``data_version`` from user_stats, or a content-addressed
+file path), so invalidation across server processes comes for free: a
+write in any process bumps the version in SQLite and every process simply
+stops asking for the old keys, which then age out of the LRU.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def approx_size(value):
+    """Rough in-memory footprint of plain data (dicts, lists, str, bytes...)"""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(approx_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """Thread-safe LRU bounded by total bytes, with an optional TTL per entry"""
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, size, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.size -= size
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = approx_size(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size, time.monotonic())
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+        return value
+
+    def get_or_compute(self, key, compute, size=None):
+        """Cached value for ``key``, computing and storing it on a miss"""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = self.put(key, compute(), size)
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class RenderCache:
+    """The caches one Streamlit server process keeps for gallery reruns"""
+
+    def __init__(self, page_bytes=16 * 1024 * 1024, thumbnail_bytes=128 * 1024 * 1024,
+                 fragment_bytes=8 * 1024 * 1024, page_ttl=60):
+        # (username, data_version, cursor) -> (cards, next_cursor, derivatives).
+        # The TTL only exists so view counts, which don't bump the version, refresh.
+        self.pages = LRUCache(page_bytes, ttl=page_ttl)
+        # derivative path -> file bytes; paths are content-addressed, so immutable
+        self.thumbnails = LRUCache(thumbnail_bytes)
+        # (filename, slot) -> card action-button HTML
+        self.fragments = LRUCache(fragment_bytes)
+
+    def read_file(self, path):
+        def load():
+            with open(path, 'rb') as f:
+                return f.read()
+        return self.thumbnails.get_or_compute(path, load)
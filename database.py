@@ -0,0 +1,1338 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from similarity import HASH_CHUNKS, SIMILAR_DISTANCE, chunk_probes, hamming, hash_chunks, to_signed, to_unsigned
+
+DB_FILE = "user_data/images.db"
+
+logger = logging.getLogger(__name__)
+
+# Columns the gallery card needs; keeps page queries off the wide rows
+CARD_COLUMNS = (
+    'id', 'filename', 'original_name', 'file_path', 'file_size', 'content_hash',
+    'upload_time', 'expires_at', 'views',
+    'width', 'height', 'image_format', 'frame_count', 'orientation', 'duration_ms',
+)
+# Header metadata captured by imaging.probe_image at upload time
+METADATA_COLUMNS = ('image_format', 'width', 'height', 'color_mode', 'frame_count', 'orientation', 'duration_ms')
+# Rows exported alongside the files (see exporter.py)
+EXPORT_COLUMNS = (
+    'id', 'filename', 'original_name', 'file_path', 'file_size', 'file_extension', 'image_format',
+    'width', 'height', 'upload_time', 'expires_at', 'views', 'content_hash', 'original_format',
+)
+# What the serving path needs to resolve a filename (see locations.py)
+LOCATION_COLUMNS = (
+    'filename', 'file_path', 'file_size', 'expires_at', 'username', 'content_hash',
+    'original_name', 'file_extension', 'image_format', 'original_format',
+)
+GALLERY_PAGE_SIZE = 12
+
+# Connection tuning applied to every pooled connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class ConnectionPool:
+    """Process-wide pool handing out one SQLite connection per thread"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.schema_ready = False
+        self.schema_lock = threading.Lock()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._prune()
+                self._connections[threading.get_ident()] = (threading.current_thread(), conn)
+        return conn
+
+    def _prune(self):
+        # Streamlit script threads come and go; close what they left behind
+        for ident, (thread, conn) in list(self._connections.items()):
+            if not thread.is_alive():
+                conn.close()
+                del self._connections[ident]
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        """Run a block inside one transaction on this thread's connection"""
+        conn = self.connection()
+        if conn.in_transaction:
+            # Nested use joins the outer transaction
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def close_all(self):
+        with self._lock:
+            for thread, conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_file=DB_FILE):
+    """Return the pool for ``db_file``, creating it once per process"""
+    with _pools_lock:
+        pool = _pools.get(db_file)
+        if pool is None:
+            os.makedirs(os.path.dirname(db_file) or ".", exist_ok=True)
+            pool = _pools[db_file] = ConnectionPool(db_file)
+        return pool
+
+
+def _migrate_base_schema(conn):
+    """v1: users and images tables (no-op on databases that predate migrations)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            media_path TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            file_extension TEXT NOT NULL,
+            upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delete_key TEXT UNIQUE,
+            auto_delete_hours INTEGER DEFAULT 0,
+            expires_at TIMESTAMP,
+            views INTEGER DEFAULT 0,
+            FOREIGN KEY (username) REFERENCES users (username)
+        )
+    ''')
+
+
+def _migrate_image_indexes(conn):
+    """v2: indexes for the gallery, filename lookups and expiry sweeps"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_images_user_upload
+        ON images (username, upload_time DESC)
+    ''')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_images_filename
+        ON images (filename)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_images_expires_at
+        ON images (expires_at) WHERE expires_at IS NOT NULL
+    ''')
+    conn.execute("ANALYZE images")
+
+
+def _migrate_gallery_page_index(conn):
+    """v3: (username, upload_time DESC, id DESC) so keyset pages are one index seek"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_images_user_page
+        ON images (username, upload_time DESC, id DESC)
+    ''')
+    conn.execute("DROP INDEX IF EXISTS idx_images_user_upload")
+
+
+def _migrate_image_derivatives(conn):
+    """v4: downscaled renditions (thumbnails, previews) of each image"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_derivatives (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            format TEXT NOT NULL,
+            path TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            file_size INTEGER NOT NULL,
+            FOREIGN KEY (image_id) REFERENCES images (id),
+            UNIQUE (image_id, kind, format)
+        )
+    ''')
+
+
+def _migrate_content_addressed_storage(conn):
+    """v5: content hashes, and indexes for counting references to stored files"""
+    conn.execute("ALTER TABLE images ADD COLUMN content_hash TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_file_path ON images (file_path)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_media_path ON images (media_path)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_derivatives_path ON image_derivatives (path)")
+
+
+def _migrate_worker_leases(conn):
+    """v6: leases that elect one process per deployment for background work"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS worker_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+
+def _migrate_image_metadata(conn):
+    """v7: header metadata so nothing has to open an image just to lay it out"""
+    conn.execute("ALTER TABLE images ADD COLUMN image_format TEXT")
+    conn.execute("ALTER TABLE images ADD COLUMN width INTEGER")
+    conn.execute("ALTER TABLE images ADD COLUMN height INTEGER")
+    conn.execute("ALTER TABLE images ADD COLUMN color_mode TEXT")
+    conn.execute("ALTER TABLE images ADD COLUMN frame_count INTEGER")
+    conn.execute("ALTER TABLE images ADD COLUMN orientation INTEGER")
+
+
+_USER_STATS_AGGREGATE = '''
+    SELECT username, COUNT(*), SUM(file_size), COUNT(expires_at), MIN(expires_at)
+    FROM images
+    GROUP BY username
+'''
+_USER_STATS_REBUILD = f'''
+    INSERT INTO user_stats (username, image_count, total_bytes, active_count, next_expiry)
+    {_USER_STATS_AGGREGATE}
+'''
+
+
+def _migrate_user_stats(conn):
+    """v8: per-user totals kept up to date by every write to images"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            username TEXT PRIMARY KEY,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            active_count INTEGER NOT NULL DEFAULT 0,
+            next_expiry TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_images_user_expires_at
+        ON images (username, expires_at) WHERE expires_at IS NOT NULL
+    ''')
+    conn.execute(_USER_STATS_REBUILD)
+
+
+def _migrate_user_data_version(conn):
+    """v9: per-user counter bumped by every write that changes what the gallery shows"""
+    conn.execute("ALTER TABLE user_stats ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_archive_imports(conn):
+    """v10: progress of bulk archive imports, so an interrupted one can resume"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_imports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            archive_name TEXT NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            imported INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            completed_at TIMESTAMP,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (username, fingerprint)
+        )
+    ''')
+
+
+def _migrate_exports(conn):
+    """v11: export requests, referenced by id from signed download links"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS exports (
+            id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            filenames TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migrate_maintenance_cursors(conn):
+    """v12: where long-running maintenance passes (e.g. fsck) should resume"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_cursors (
+            name TEXT PRIMARY KEY,
+            position TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def owner_token(username):
+    """Single FTS token standing for a user, so searches intersect on owner first"""
+    return 'u' + hashlib.blake2b(username.encode(), digest_size=10).hexdigest()
+
+
+def fts_query(text):
+    """MATCH expression requiring every word of ``text`` as a prefix, or None"""
+    words = re.findall(r'\w+', text or '')
+    return ' AND '.join(f'"{word}"*' for word in words) or None
+
+
+def _migrate_image_search(conn):
+    """v13: full-text index over image names, plus indexes behind the search filters"""
+    # rowid is images.id; kept in step by save_image/_delete_image_rows
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+            original_name, owner,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    ''')
+    conn.create_function('owner_token', 1, owner_token, deterministic=True)
+    conn.execute('''
+        INSERT INTO images_fts (rowid, original_name, owner)
+        SELECT id, original_name, owner_token(username) FROM images
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_images_user_extension
+        ON images (username, file_extension, upload_time DESC, id DESC)
+    ''')
+    # Gallery order plus the filter columns, so filtered pages are found
+    # inside the index without visiting non-matching rows
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_images_user_filters
+        ON images (username, upload_time DESC, id DESC, file_size, file_extension, expires_at)
+    ''')
+
+
+def _migrate_jobs(conn):
+    """v14: durable background job queue (see worker.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            image_id INTEGER,
+            payload TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            run_after REAL NOT NULL,
+            lease_owner TEXT,
+            lease_expires REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (run_after) WHERE status = 'pending'
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jobs_running ON jobs (lease_expires) WHERE status = 'running'
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jobs_image ON jobs (image_id) WHERE image_id IS NOT NULL
+    ''')
+
+
+def _migrate_transcoding(conn):
+    """v15: what re-encoding (see transcoding.py) did to each image"""
+    # NULL original_size: stored exactly as uploaded
+    conn.execute("ALTER TABLE images ADD COLUMN original_size INTEGER")
+    conn.execute("ALTER TABLE images ADD COLUMN original_format TEXT")
+    conn.execute("ALTER TABLE images ADD COLUMN transcode_policy TEXT")
+
+
+def _migrate_animation_duration(conn):
+    """v16: total play time of animated images, in milliseconds"""
+    conn.execute("ALTER TABLE images ADD COLUMN duration_ms INTEGER")
+
+
+def _migrate_perceptual_hash(conn):
+    """v17: perceptual hashes and their multi-index lookup table (see similarity.py)"""
+    conn.execute("ALTER TABLE images ADD COLUMN phash INTEGER")
+    # One row per (image, chunk); the key is the lookup, phash rides along
+    # so candidates are checked without touching images
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_hash_chunks (
+            username TEXT NOT NULL,
+            chunk INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            image_id INTEGER NOT NULL,
+            phash INTEGER NOT NULL,
+            PRIMARY KEY (username, chunk, value, image_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_image_hash_chunks_image ON image_hash_chunks (image_id)
+    ''')
+
+
+# Schema history; position N-1 upgrades a database to PRAGMA user_version N.
+# Only ever append here -- deployed databases record how far they have got.
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_image_indexes,
+    _migrate_gallery_page_index,
+    _migrate_image_derivatives,
+    _migrate_content_addressed_storage,
+    _migrate_worker_leases,
+    _migrate_image_metadata,
+    _migrate_user_stats,
+    _migrate_user_data_version,
+    _migrate_archive_imports,
+    _migrate_exports,
+    _migrate_maintenance_cursors,
+    _migrate_image_search,
+    _migrate_jobs,
+    _migrate_transcoding,
+    _migrate_animation_duration,
+    _migrate_perceptual_hash,
+]
+
+
+class DatabaseManager:
+    def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        self.pool = get_pool(db_file)
+        with self.pool.schema_lock:
+            if not self.pool.schema_ready:
+                self.init_database()
+                self.pool.schema_ready = True
+
+    def init_database(self):
+        """Bring the schema up to the latest version, one migration at a time"""
+        applied = 0
+        while True:
+            # Re-read the version under the write lock so that processes
+            # starting together never run the same migration twice
+            with self.pool.transaction() as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    return applied
+                MIGRATIONS[version](conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+            applied += 1
+
+    def register_user(self, username, password):
+        try:
+            with self.pool.transaction() as conn:
+                conn.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password))
+            return True, "Registration successful"
+        except sqlite3.IntegrityError:
+            return False, "Username already exists"
+
+    def login_user(self, username, password):
+        conn = self.pool.connection()
+        result = conn.execute('SELECT password FROM users WHERE username = ?', (username,)).fetchone()
+
+        if result and result[0] == password:
+            return True, "Login successful"
+        return False, "Invalid credentials"
+
+    def user_exists(self, username):
+        conn = self.pool.connection()
+        return conn.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone() is not None
+
+    def save_image(self, username, image_data, derivatives=()):
+        """Insert an image row (and its derivatives) and return the new id"""
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('''
+                INSERT INTO images (username, filename, original_name, file_path, media_path,
+                                  file_size, file_extension, delete_key, auto_delete_hours, expires_at,
+                                  content_hash, image_format, width, height, color_mode, frame_count,
+                                  orientation, duration_ms, transcode_policy, phash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                username, image_data['filename'], image_data['original_name'],
+                image_data['file_path'], image_data['media_path'], image_data['file_size'],
+                image_data['file_extension'], image_data['delete_key'],
+                image_data['auto_delete_hours'], image_data['expires_at'],
+                image_data.get('content_hash'),
+                *(image_data.get(column) for column in METADATA_COLUMNS),
+                image_data.get('transcode_policy'),
+                None if image_data.get('phash') is None else to_signed(image_data['phash'])
+            ))
+            image_id = cursor.lastrowid
+            if image_data.get('phash') is not None:
+                self._index_hash(conn, username, image_id, image_data['phash'])
+            conn.execute('''
+                INSERT INTO images_fts (rowid, original_name, owner) VALUES (?, ?, ?)
+            ''', (image_id, image_data['original_name'], owner_token(username)))
+            conn.execute('''
+                INSERT INTO user_stats (username, image_count, total_bytes, active_count, next_expiry)
+                VALUES (?, 1, ?, ?, ?)
+                ON CONFLICT (username) DO UPDATE SET
+                    data_version = data_version + 1,
+                    image_count = image_count + 1,
+                    total_bytes = total_bytes + excluded.total_bytes,
+                    active_count = active_count + excluded.active_count,
+                    next_expiry = CASE
+                        WHEN next_expiry IS NULL OR excluded.next_expiry < next_expiry
+                        THEN excluded.next_expiry ELSE next_expiry END
+            ''', (
+                username, image_data['file_size'],
+                1 if image_data['expires_at'] else 0, image_data['expires_at']
+            ))
+            self.save_derivatives(image_id, derivatives)
+        return image_id
+
+    def save_derivatives(self, image_id, derivatives):
+        with self.pool.transaction() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO image_derivatives
+                    (image_id, kind, format, path, width, height, file_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (image_id, d['kind'], d['format'], d['path'], d['width'], d['height'], d['file_size'])
+                for d in derivatives
+            ])
+            if derivatives:
+                self._bump_data_version(conn, 'SELECT username FROM images WHERE id = ?', (image_id,))
+
+    def _bump_data_version(self, conn, usernames_sql, params):
+        """Invalidate cached gallery data for the users selected by ``usernames_sql``"""
+        conn.execute(f'''
+            UPDATE user_stats SET data_version = data_version + 1
+            WHERE username IN ({usernames_sql})
+        ''', params)
+
+    def get_derivatives(self, image_ids):
+        """Map each of ``image_ids`` to its list of derivative dicts"""
+        image_ids = list(image_ids)
+        result = {image_id: [] for image_id in image_ids}
+        if not image_ids:
+            return result
+        conn = self.pool.connection()
+        placeholders = ', '.join('?' * len(image_ids))
+        rows = conn.execute(f'''
+            SELECT image_id, kind, format, path, width, height, file_size
+            FROM image_derivatives
+            WHERE image_id IN ({placeholders})
+        ''', image_ids).fetchall()
+        for row in rows:
+            result[row['image_id']].append(dict(row))
+        return result
+
+    def get_derivatives_by_hash(self, content_hash):
+        """Derivatives already generated for another image with the same bytes"""
+        conn = self.pool.connection()
+        row = conn.execute('''
+            SELECT d.image_id FROM image_derivatives d
+            JOIN images i ON i.id = d.image_id
+            WHERE i.content_hash = ?
+            LIMIT 1
+        ''', (content_hash,)).fetchone()
+        if row is None:
+            return []
+        return self.get_derivatives([row['image_id']])[row['image_id']]
+
+    def get_images_missing_derivatives(self, after_id=0, limit=100):
+        """Next batch of images (by id) that have no derivatives yet"""
+        conn = self.pool.connection()
+        rows = conn.execute('''
+            SELECT id, file_path FROM images
+            WHERE id > ? AND NOT EXISTS (
+                SELECT 1 FROM image_derivatives d WHERE d.image_id = images.id
+            )
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_user_images(self, username):
+        conn = self.pool.connection()
+        rows = conn.execute('''
+            SELECT * FROM images
+            WHERE username = ?
+            ORDER BY upload_time DESC
+        ''', (username,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_image_by_filename(self, filename):
+        conn = self.pool.connection()
+        row = conn.execute('''
+            SELECT * FROM images WHERE filename = ?
+        ''', (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def get_image_location(self, filename):
+        columns = ', '.join(LOCATION_COLUMNS)
+        conn = self.pool.connection()
+        row = conn.execute(f'''
+            SELECT {columns} FROM images WHERE filename = ?
+        ''', (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def get_recent_locations(self, limit):
+        """Location rows for the ``limit`` most recent uploads"""
+        columns = ', '.join(LOCATION_COLUMNS)
+        conn = self.pool.connection()
+        rows = conn.execute(f'''
+            SELECT {columns} FROM images ORDER BY id DESC LIMIT ?
+        ''', (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_user_images_page(self, username, after_cursor=None, limit=GALLERY_PAGE_SIZE):
+        """Return one gallery page and the cursor for the page after it.
+
+        ``after_cursor`` is the ``(upload_time, id)`` pair of the last card
+        already shown; the returned cursor is None on the final page.
+        """
+        columns = ', '.join(CARD_COLUMNS)
+        conn = self.pool.connection()
+        if after_cursor is None:
+            rows = conn.execute(f'''
+                SELECT {columns} FROM images
+                WHERE username = ?
+                ORDER BY upload_time DESC, id DESC
+                LIMIT ?
+            ''', (username, limit + 1)).fetchall()
+        else:
+            rows = conn.execute(f'''
+                SELECT {columns} FROM images
+                WHERE username = ? AND (upload_time, id) < (?, ?)
+                ORDER BY upload_time DESC, id DESC
+                LIMIT ?
+            ''', (username, *after_cursor, limit + 1)).fetchall()
+
+        images = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = (images[-1]['upload_time'], images[-1]['id'])
+        return images, next_cursor
+
+    def search_images(self, username, text=None, uploaded_from=None, uploaded_to=None,
+                      min_size=None, max_size=None, extensions=None, expiring=None,
+                      after_cursor=None, limit=GALLERY_PAGE_SIZE):
+        """One page of a user's images matching the search, newest first.
+
+        ``text`` matches words (as prefixes) in the original file name;
+        ``uploaded_from``/``uploaded_to`` bound upload_time (datetimes, the
+        end exclusive); ``expiring`` True/False keeps only images that
+        will/won't auto-delete. Paginates like :meth:`get_user_images_page`.
+        """
+        conditions = ['images.username = ?']
+        params = [username]
+        if uploaded_from is not None:
+            conditions.append('images.upload_time >= ?')
+            params.append(uploaded_from.strftime('%Y-%m-%d %H:%M:%S'))
+        if uploaded_to is not None:
+            conditions.append('images.upload_time < ?')
+            params.append(uploaded_to.strftime('%Y-%m-%d %H:%M:%S'))
+        if min_size is not None:
+            conditions.append('images.file_size >= ?')
+            params.append(min_size)
+        if max_size is not None:
+            conditions.append('images.file_size <= ?')
+            params.append(max_size)
+        if extensions:
+            conditions.append(f"images.file_extension IN ({', '.join('?' * len(extensions))})")
+            params.extend(extensions)
+        if expiring is not None:
+            conditions.append(f"images.expires_at IS {'NOT ' if expiring else ''}NULL")
+
+        conn = self.pool.connection()
+        match = fts_query(text)
+        if match:
+            # Driven by the FTS index (already narrowed to this owner) in
+            # rowid order, which is upload order, so a page stops after
+            # ``limit`` hits instead of sorting every match
+            if after_cursor is not None:
+                conditions.append('images_fts.rowid < ?')
+                params.append(after_cursor[1])
+            rows = conn.execute(f'''
+                SELECT images.id FROM images_fts CROSS JOIN images ON images.id = images_fts.rowid
+                WHERE images_fts MATCH ? AND {' AND '.join(conditions)}
+                ORDER BY images_fts.rowid DESC
+                LIMIT ?
+            ''', (f'owner:{owner_token(username)} AND original_name:({match})', *params, limit + 1)).fetchall()
+        else:
+            # Filters are checked inside idx_images_user_filters while it is
+            # walked in gallery order; only the page's rows are read
+            if after_cursor is not None:
+                conditions.append('(images.upload_time, images.id) < (?, ?)')
+                params.extend(after_cursor)
+            rows = conn.execute(f'''
+                SELECT images.id FROM images
+                WHERE {' AND '.join(conditions)}
+                ORDER BY images.upload_time DESC, images.id DESC
+                LIMIT ?
+            ''', (*params, limit + 1)).fetchall()
+
+        image_ids = [row[0] for row in rows[:limit]]
+        columns = ', '.join(CARD_COLUMNS)
+        cards = {row['id']: dict(row) for row in conn.execute(f'''
+            SELECT {columns} FROM images WHERE id IN ({', '.join('?' * len(image_ids))})
+        ''', image_ids)}
+        images = [cards[image_id] for image_id in image_ids]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = (images[-1]['upload_time'], images[-1]['id'])
+        return images, next_cursor
+
+    def _index_hash(self, conn, username, image_id, phash):
+        conn.executemany('''
+            INSERT OR REPLACE INTO image_hash_chunks (username, chunk, value, image_id, phash)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (username, chunk, value, image_id, to_signed(phash))
+            for chunk, value in enumerate(hash_chunks(phash))
+        ])
+
+    def set_image_hash(self, image_id, phash):
+        with self.pool.transaction() as conn:
+            row = conn.execute('SELECT username FROM images WHERE id = ?', (image_id,)).fetchone()
+            if row is None:
+                return
+            conn.execute('UPDATE images SET phash = ? WHERE id = ?', (to_signed(phash), image_id))
+            conn.execute('DELETE FROM image_hash_chunks WHERE image_id = ?', (image_id,))
+            self._index_hash(conn, row['username'], image_id, phash)
+
+    def copy_image_hash(self, image_id, content_hash):
+        """Give ``image_id`` the perceptual hash of another image with the same bytes; False if none has one"""
+        conn = self.pool.connection()
+        row = conn.execute('''
+            SELECT phash FROM images WHERE content_hash = ? AND id != ? AND phash IS NOT NULL LIMIT 1
+        ''', (content_hash, image_id)).fetchone()
+        if row is None:
+            return False
+        self.set_image_hash(image_id, to_unsigned(row['phash']))
+        return True
+
+    def get_images_missing_phash(self, after_id=0, limit=100):
+        """Next batch of images stored before perceptual hashing"""
+        conn = self.pool.connection()
+        rows = conn.execute('''
+            SELECT id, file_path FROM images
+            WHERE id > ? AND phash IS NULL
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def find_similar(self, username, phash, max_distance=SIMILAR_DISTANCE, exclude_id=None, limit=50):
+        """``[(image_id, distance), ...]`` of the user's images within ``max_distance`` bits, nearest first"""
+        radius = max_distance // HASH_CHUNKS
+        conn = self.pool.connection()
+        matches = {}
+        for chunk, value in enumerate(hash_chunks(phash)):
+            probes = chunk_probes(value, radius)
+            rows = conn.execute(f'''
+                SELECT image_id, phash FROM image_hash_chunks
+                WHERE username = ? AND chunk = ? AND value IN ({', '.join('?' * len(probes))})
+            ''', (username, chunk, *probes))
+            for image_id, candidate in rows:
+                if image_id == exclude_id or image_id in matches:
+                    continue
+                distance = hamming(phash, candidate)
+                if distance <= max_distance:
+                    matches[image_id] = distance
+        # Newest first among equally close matches
+        return sorted(matches.items(), key=lambda match: (match[1], -match[0]))[:limit]
+
+    def find_similar_images(self, username, phash, max_distance=SIMILAR_DISTANCE, exclude_id=None, limit=50):
+        """Gallery cards for :meth:`find_similar`, each with its ``distance``"""
+        matches = self.find_similar(username, phash, max_distance, exclude_id, limit)
+        if not matches:
+            return []
+        columns = ', '.join(CARD_COLUMNS)
+        conn = self.pool.connection()
+        cards = {row['id']: dict(row) for row in conn.execute(f'''
+            SELECT {columns} FROM images WHERE id IN ({', '.join('?' * len(matches))})
+        ''', [image_id for image_id, _ in matches])}
+        return [{**cards[image_id], 'distance': distance} for image_id, distance in matches if image_id in cards]
+
+    def get_image_hash(self, username, image_id):
+        conn = self.pool.connection()
+        row = conn.execute('''
+            SELECT phash FROM images WHERE id = ? AND username = ?
+        ''', (image_id, username)).fetchone()
+        return row[0] if row else None
+
+    def get_user_stats(self, username):
+        """Totals for the sidebar dashboard, read from the user_stats row"""
+        conn = self.pool.connection()
+        row = conn.execute('''
+            SELECT image_count AS total_images,
+                   total_bytes AS total_size,
+                   active_count AS active_images,
+                   next_expiry,
+                   data_version
+            FROM user_stats
+            WHERE username = ?
+        ''', (username,)).fetchone()
+        if row is None:
+            return {'total_images': 0, 'total_size': 0, 'active_images': 0, 'next_expiry': None,
+                    'data_version': 0}
+        return dict(row)
+
+    def check_user_stats(self, repair=False):
+        """Compare user_stats against images; returns the usernames that differ.
+
+        With ``repair`` the table is rebuilt from images in the same
+        transaction, so no write can land between the check and the fix.
+        """
+        with self.pool.transaction() as conn:
+            # Rows left at all-zero by deletes are equivalent to missing rows
+            mismatched = sorted({row[0] for row in conn.execute(f'''
+                WITH stored AS (
+                    SELECT username, image_count, total_bytes, active_count, next_expiry
+                    FROM user_stats
+                    WHERE image_count != 0 OR total_bytes != 0 OR active_count != 0
+                       OR next_expiry IS NOT NULL
+                ), expected AS ({_USER_STATS_AGGREGATE})
+                SELECT username FROM (SELECT * FROM stored EXCEPT SELECT * FROM expected)
+                UNION
+                SELECT username FROM (SELECT * FROM expected EXCEPT SELECT * FROM stored)
+            ''')})
+            if repair and mismatched:
+                # Rebuild in place so data_version keeps moving forward
+                conn.execute('''
+                    UPDATE user_stats
+                    SET image_count = 0, total_bytes = 0, active_count = 0, next_expiry = NULL,
+                        data_version = data_version + 1
+                ''')
+                conn.execute(f'''
+                    {_USER_STATS_REBUILD}
+                    ON CONFLICT (username) DO UPDATE SET
+                        image_count = excluded.image_count, total_bytes = excluded.total_bytes,
+                        active_count = excluded.active_count, next_expiry = excluded.next_expiry
+                ''')
+        return mismatched
+
+    def _update_user_stats_after_delete(self, conn, images):
+        removed = {}
+        for image in images:
+            stats = removed.setdefault(image['username'], [0, 0, 0, None])
+            stats[0] += 1
+            stats[1] += image['file_size']
+            if image['expires_at'] is not None:
+                stats[2] += 1
+                stats[3] = min(stats[3] or image['expires_at'], image['expires_at'])
+
+        for username, (count, size, active, earliest_removed) in removed.items():
+            conn.execute('''
+                UPDATE user_stats
+                SET image_count = image_count - ?, total_bytes = total_bytes - ?,
+                    active_count = active_count - ?, data_version = data_version + 1
+                WHERE username = ?
+            ''', (count, size, active, username))
+            if earliest_removed is not None:
+                # Only re-derive next_expiry when the earliest one may have gone
+                conn.execute('''
+                    UPDATE user_stats SET next_expiry = (
+                        SELECT MIN(expires_at) FROM images
+                        WHERE username = ? AND expires_at IS NOT NULL
+                    )
+                    WHERE username = ? AND next_expiry >= ?
+                ''', (username, username, earliest_removed))
+
+    def is_path_referenced(self, path):
+        """True while any image or derivative row still points at ``path``"""
+        conn = self.pool.connection()
+        return conn.execute('''
+            SELECT 1 FROM images WHERE file_path = ?
+            UNION ALL SELECT 1 FROM images WHERE media_path = ?
+            UNION ALL SELECT 1 FROM image_derivatives WHERE path = ?
+            LIMIT 1
+        ''', (path, path, path)).fetchone() is not None
+
+    def _delete_image_rows(self, conn, images):
+        """Delete image rows and unlink files that no remaining row references.
+
+        Runs inside the caller's write transaction, so an upload reusing the
+        same stored file cannot slip in between the check and the unlink.
+        Returns the number of bytes freed on disk.
+        """
+        image_ids = [image['id'] for image in images]
+        paths = {path for image in images for path in (image['file_path'], image['media_path'])}
+        for derivatives in self.get_derivatives(image_ids).values():
+            paths.update(d['path'] for d in derivatives)
+
+        conn.executemany('DELETE FROM image_derivatives WHERE image_id = ?', [(i,) for i in image_ids])
+        conn.executemany('DELETE FROM images WHERE id = ?', [(i,) for i in image_ids])
+        conn.executemany('DELETE FROM images_fts WHERE rowid = ?', [(i,) for i in image_ids])
+        conn.executemany('DELETE FROM jobs WHERE image_id = ?', [(i,) for i in image_ids])
+        conn.executemany('DELETE FROM image_hash_chunks WHERE image_id = ?', [(i,) for i in image_ids])
+        self._update_user_stats_after_delete(conn, images)
+        return self.release_files(paths)
+
+    def release_files(self, paths):
+        """Unlink whichever of ``paths`` no row references; returns the bytes freed.
+
+        The check and unlink share a write transaction (the caller's, if
+        any), so an upload reusing a file either commits first or sees it gone.
+        """
+        freed = 0
+        with self.pool.transaction():
+            for path in paths:
+                if self.is_path_referenced(path):
+                    continue
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # Nothing references it either way; `manage.py fsck` collects the file later
+                    logger.exception("Could not remove %s", path)
+        return freed
+
+    def get_referenced_paths(self, paths):
+        """The subset of ``paths`` that some image or derivative row points at"""
+        paths = list(paths)
+        referenced = set()
+        conn = self.pool.connection()
+        for start in range(0, len(paths), 300):
+            chunk = paths[start:start + 300]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = conn.execute(f'''
+                SELECT file_path FROM images WHERE file_path IN ({placeholders})
+                UNION SELECT media_path FROM images WHERE media_path IN ({placeholders})
+                UNION SELECT path FROM image_derivatives WHERE path IN ({placeholders})
+            ''', chunk * 3).fetchall()
+            referenced.update(row[0] for row in rows)
+        return referenced
+
+    def get_pending_release_paths(self, paths):
+        """The subset of ``paths`` that a queued ``release-files`` job will remove"""
+        paths = list(paths)
+        pending = set()
+        conn = self.pool.connection()
+        for start in range(0, len(paths), 300):
+            chunk = paths[start:start + 300]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = conn.execute(f'''
+                SELECT DISTINCT released.value FROM jobs, json_each(jobs.payload, '$.paths') AS released
+                WHERE jobs.kind = 'release-files' AND jobs.status != 'failed'
+                  AND released.value IN ({placeholders})
+            ''', chunk).fetchall()
+            pending.update(row[0] for row in rows)
+        return pending
+
+    def delete_images(self, image_ids):
+        """Delete images by id (and their unreferenced files); returns how many went"""
+        image_ids = list(image_ids)
+        if not image_ids:
+            return 0
+        with self.pool.transaction() as conn:
+            images = conn.execute(f'''
+                SELECT id, username, file_path, media_path, file_size, expires_at FROM images
+                WHERE id IN ({', '.join('?' * len(image_ids))})
+            ''', image_ids).fetchall()
+            self._delete_image_rows(conn, images)
+        return len(images)
+
+    def delete_image(self, username, filename):
+        with self.pool.transaction() as conn:
+            image = conn.execute('''
+                SELECT id, username, file_path, media_path, file_size, expires_at
+                FROM images WHERE username = ? AND filename = ?
+            ''', (username, filename)).fetchone()
+            if image is None:
+                return False
+            self._delete_image_rows(conn, [image])
+            return True
+
+    def increment_views(self, filename):
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE images SET views = views + 1 WHERE filename = ?
+            ''', (filename,))
+
+    def add_views(self, counts, chunk_size=400):
+        """Add ``{filename: hits}`` to the view counts in a single transaction"""
+        items = list(counts.items())
+        with self.pool.transaction() as conn:
+            for start in range(0, len(items), chunk_size):
+                chunk = items[start:start + chunk_size]
+                cases = ' '.join('WHEN ? THEN ?' for _ in chunk)
+                placeholders = ', '.join('?' * len(chunk))
+                params = [value for item in chunk for value in item]
+                params += [filename for filename, _ in chunk]
+                conn.execute(f'''
+                    UPDATE images SET views = views + CASE filename {cases} ELSE 0 END
+                    WHERE filename IN ({placeholders})
+                ''', params)
+
+    def cleanup_expired_images(self, batch_size=500):
+        total = 0
+        while True:
+            deleted = self.delete_expired_batch(datetime.now(), batch_size)
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+    def delete_expired_batch(self, now, limit):
+        """Delete up to ``limit`` images that expired before ``now``, in one transaction"""
+        with self.pool.transaction() as conn:
+            expired_images = conn.execute('''
+                SELECT id, username, file_path, media_path, file_size, expires_at FROM images
+                WHERE expires_at IS NOT NULL AND expires_at < ?
+                ORDER BY expires_at
+                LIMIT ?
+            ''', (now, limit)).fetchall()
+            self._delete_image_rows(conn, expired_images)
+        return len(expired_images)
+
+    def get_next_expiry(self):
+        """Earliest pending expires_at (from the partial index), or None"""
+        conn = self.pool.connection()
+        row = conn.execute('''
+            SELECT MIN(expires_at) FROM images WHERE expires_at IS NOT NULL
+        ''').fetchone()
+        return datetime.fromisoformat(row[0]) if row[0] else None
+
+    def acquire_lease(self, name, owner, ttl):
+        """Take or renew the named lease; True if ``owner`` now holds it"""
+        now = time.time()
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                INSERT INTO worker_leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE worker_leases.owner = excluded.owner OR worker_leases.expires_at < ?
+            ''', (name, owner, now + ttl, now))
+            row = conn.execute('SELECT owner FROM worker_leases WHERE name = ?', (name,)).fetchone()
+        return row['owner'] == owner
+
+    def release_lease(self, name, owner):
+        with self.pool.transaction() as conn:
+            conn.execute('DELETE FROM worker_leases WHERE name = ? AND owner = ?', (name, owner))
+
+    def get_archive_import(self, username, fingerprint, archive_name):
+        """The import record for this archive, created on first sight"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                INSERT INTO archive_imports (username, fingerprint, archive_name) VALUES (?, ?, ?)
+                ON CONFLICT (username, fingerprint) DO NOTHING
+            ''', (username, fingerprint, archive_name))
+            row = conn.execute('''
+                SELECT * FROM archive_imports WHERE username = ? AND fingerprint = ?
+            ''', (username, fingerprint)).fetchone()
+        return dict(row)
+
+    def record_import_progress(self, import_id, position, imported=0, failed=0, completed=False):
+        """Advance an import past ``position`` archive entries.
+
+        Called inside the transaction that commits the batch's images, so a
+        resumed import never re-imports or skips an entry.
+        """
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE archive_imports
+                SET position = ?, imported = imported + ?, failed = failed + ?,
+                    completed_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END
+                WHERE id = ?
+            ''', (position, imported, failed, completed, import_id))
+
+    def create_export(self, username, filenames=None):
+        """Record what an export covers; ``filenames`` None means every image"""
+        export_id = secrets.token_urlsafe(16)
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                INSERT INTO exports (id, username, filenames) VALUES (?, ?, ?)
+            ''', (export_id, username, None if filenames is None else json.dumps(list(filenames))))
+        return export_id
+
+    def get_export(self, export_id):
+        conn = self.pool.connection()
+        row = conn.execute('SELECT * FROM exports WHERE id = ?', (export_id,)).fetchone()
+        if row is None:
+            return None
+        export = dict(row)
+        if export['filenames'] is not None:
+            export['filenames'] = json.loads(export['filenames'])
+        return export
+
+    def iter_export_images(self, username, filenames=None, batch_size=500):
+        """Yield a user's images (or just the named ones), a batch per query.
+
+        Whole-library exports walk idx_images_user_page in gallery order.
+        The connection is looked up per batch because the consumer may
+        resume this generator from a different thread each time.
+        """
+        columns = ', '.join(EXPORT_COLUMNS)
+        if filenames is not None:
+            filenames = list(filenames)
+            for start in range(0, len(filenames), batch_size):
+                chunk = filenames[start:start + batch_size]
+                rows = self.pool.connection().execute(f'''
+                    SELECT {columns} FROM images
+                    WHERE username = ? AND filename IN ({', '.join('?' * len(chunk))})
+                    ORDER BY id
+                ''', [username, *chunk]).fetchall()
+                yield from (dict(row) for row in rows)
+            return
+
+        rows = self.pool.connection().execute(f'''
+            SELECT {columns} FROM images
+            WHERE username = ?
+            ORDER BY upload_time DESC, id DESC
+            LIMIT ?
+        ''', (username, batch_size)).fetchall()
+        while rows:
+            yield from (dict(row) for row in rows)
+            rows = self.pool.connection().execute(f'''
+                SELECT {columns} FROM images
+                WHERE username = ? AND (upload_time, id) < (?, ?)
+                ORDER BY upload_time DESC, id DESC
+                LIMIT ?
+            ''', (username, rows[-1]['upload_time'], rows[-1]['id'], batch_size)).fetchall()
+
+    def enqueue_job(self, kind, image_id=None, payload=None, delay=0, max_attempts=5):
+        """Queue a job; joins the caller's transaction if there is one"""
+        with self.pool.transaction() as conn:
+            cursor = conn.execute('''
+                INSERT INTO jobs (kind, image_id, payload, run_after, max_attempts) VALUES (?, ?, ?, ?, ?)
+            ''', (kind, image_id, None if payload is None else json.dumps(payload), time.time() + delay,
+                  max_attempts))
+        return cursor.lastrowid
+
+    def claim_jobs(self, owner, lease_ttl, limit=1):
+        """Lease up to ``limit`` runnable jobs to ``owner``.
+
+        Runnable means pending and due, or running under a lease that
+        expired (its worker died). Each claim counts as an attempt.
+        """
+        now = time.time()
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE jobs SET status = 'failed', last_error = 'lease expired on final attempt'
+                WHERE status = 'running' AND lease_expires < ? AND attempts >= max_attempts
+            ''', (now,))
+            job_ids = [row[0] for row in conn.execute('''
+                SELECT id FROM jobs WHERE status = 'pending' AND run_after <= ?
+                UNION ALL
+                SELECT id FROM jobs WHERE status = 'running' AND lease_expires < ?
+                LIMIT ?
+            ''', (now, now, limit))]
+            if not job_ids:
+                return []
+            placeholders = ', '.join('?' * len(job_ids))
+            conn.execute(f'''
+                UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE id IN ({placeholders})
+            ''', (owner, now + lease_ttl, *job_ids))
+            rows = conn.execute(f'SELECT * FROM jobs WHERE id IN ({placeholders})', job_ids).fetchall()
+        jobs = [dict(row) for row in rows]
+        for job in jobs:
+            job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+        return jobs
+
+    def complete_job(self, job_id, owner):
+        """Drop a finished job; False if its lease had already passed to someone else"""
+        with self.pool.transaction() as conn:
+            row = conn.execute('''
+                DELETE FROM jobs WHERE id = ? AND lease_owner = ? RETURNING image_id
+            ''', (job_id, owner)).fetchone()
+            if row and row['image_id'] is not None:
+                # The gallery swaps its "processing" placeholder for the result
+                self._bump_data_version(conn, 'SELECT username FROM images WHERE id = ?', (row['image_id'],))
+        return row is not None
+
+    def fail_job(self, job_id, owner, error, retry_delay):
+        """Schedule a retry after ``retry_delay`` seconds, or give up after max_attempts"""
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE jobs SET
+                    status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                    run_after = ?, lease_owner = NULL, lease_expires = NULL, last_error = ?
+                WHERE id = ? AND lease_owner = ?
+            ''', (time.time() + retry_delay, error, job_id, owner))
+
+    def get_processing_images(self, image_ids):
+        """Which of ``image_ids`` still have queued or running jobs"""
+        image_ids = list(image_ids)
+        if not image_ids:
+            return set()
+        conn = self.pool.connection()
+        rows = conn.execute(f'''
+            SELECT DISTINCT image_id FROM jobs
+            WHERE image_id IN ({', '.join('?' * len(image_ids))}) AND status IN ('pending', 'running')
+        ''', image_ids).fetchall()
+        return {row[0] for row in rows}
+
+    def get_image_source(self, image_id):
+        conn = self.pool.connection()
+        row = conn.execute('''
+            SELECT id, file_path, content_hash, file_size, image_format, frame_count, phash
+            FROM images WHERE id = ?
+        ''', (image_id,)).fetchone()
+        return dict(row) if row else None
+
+    def get_images_to_transcode(self, policy_tag, after_id=0, limit=100):
+        """Next batch of images not yet processed under the policy ``policy_tag``"""
+        conn = self.pool.connection()
+        rows = conn.execute('''
+            SELECT id, file_path, content_hash, file_size, image_format, frame_count FROM images
+            WHERE id > ? AND transcode_policy IS NOT ? AND image_format IS NOT NULL
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, policy_tag, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_transcoded(self, image_id, policy_tag):
+        with self.pool.transaction() as conn:
+            conn.execute('UPDATE images SET transcode_policy = ? WHERE id = ?', (policy_tag, image_id))
+
+    def replace_image_blob(self, image_id, old_path, stored, policy_tag):
+        """Point an image at its re-encoded file; returns the paths it stopped using.
+
+        ``stored`` holds the new content_hash, file_path, file_size,
+        file_extension and metadata. Returns None (and changes nothing) if
+        the image is gone or no longer at ``old_path``.
+        """
+        with self.pool.transaction() as conn:
+            old = conn.execute('''
+                SELECT username, file_path, media_path, file_size FROM images
+                WHERE id = ? AND file_path = ?
+            ''', (image_id, old_path)).fetchone()
+            if old is None:
+                return None
+            conn.execute('''
+                UPDATE images SET
+                    original_size = COALESCE(original_size, file_size),
+                    original_format = COALESCE(original_format, image_format),
+                    content_hash = ?, file_path = ?, media_path = ?, file_size = ?, file_extension = ?,
+                    image_format = ?, width = ?, height = ?, color_mode = ?,
+                    orientation = COALESCE(?, orientation), transcode_policy = ?
+                WHERE id = ?
+            ''', (
+                stored['content_hash'], stored['file_path'], stored['file_path'], stored['file_size'],
+                stored['file_extension'], stored['image_format'], stored['width'], stored['height'],
+                stored['color_mode'], stored['orientation'], policy_tag, image_id
+            ))
+            conn.execute('''
+                UPDATE user_stats SET total_bytes = total_bytes + ?, data_version = data_version + 1
+                WHERE username = ?
+            ''', (stored['file_size'] - old['file_size'], old['username']))
+        return {old['file_path'], old['media_path']} - {stored['file_path']}
+
+    def get_transcode_savings(self, username=None):
+        """``(images re-encoded, bytes saved)``, for one user or everyone"""
+        conn = self.pool.connection()
+        row = conn.execute('''
+            SELECT COUNT(*), COALESCE(SUM(original_size - file_size), 0) FROM images
+            WHERE original_size IS NOT NULL AND (? IS NULL OR username = ?)
+        ''', (username, username)).fetchone()
+        return row[0], row[1]
+
+    def get_images_without_hash(self, after_id=0, limit=100):
+        """Next batch of images stored before content addressing"""
+        conn = self.pool.connection()
+        rows = conn.execute('''
+            SELECT id, file_path, media_path, file_extension FROM images
+            WHERE id > ? AND content_hash IS NULL
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_images_missing_metadata(self, after_id=0, limit=100):
+        """Next batch of images uploaded before (all of) their metadata was captured"""
+        conn = self.pool.connection()
+        rows = conn.execute('''
+            SELECT id, file_path FROM images
+            WHERE id > ? AND (width IS NULL OR (frame_count > 1 AND duration_ms IS NULL))
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def set_image_metadata(self, image_id, metadata):
+        assignments = ', '.join(f'{column} = ?' for column in METADATA_COLUMNS)
+        with self.pool.transaction() as conn:
+            conn.execute(
+                f'UPDATE images SET {assignments} WHERE id = ?',
+                (*(metadata[column] for column in METADATA_COLUMNS), image_id)
+            )
+            self._bump_data_version(conn, 'SELECT username FROM images WHERE id = ?', (image_id,))
+
+    def get_cursor(self, name):
+        conn = self.pool.connection()
+        row = conn.execute('SELECT position FROM maintenance_cursors WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, name, position):
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                INSERT INTO maintenance_cursors (name, position, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (name) DO UPDATE SET position = excluded.position, updated_at = excluded.updated_at
+            ''', (name, position))
+
+    def get_image_paths(self, after_id=0, limit=100):
+        """Next batch of image ids with the files they reference"""
+        conn = self.pool.connection()
+        rows = conn.execute('''
+            SELECT id, file_path, media_path FROM images
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def relocate_path(self, old_path, new_path):
+        """Repoint every row referencing ``old_path`` at ``new_path``"""
+        with self.pool.transaction() as conn:
+            self._bump_data_version(conn, '''
+                SELECT username FROM images WHERE file_path = ? OR media_path = ?
+                UNION SELECT i.username FROM image_derivatives d
+                JOIN images i ON i.id = d.image_id WHERE d.path = ?
+            ''', (old_path, old_path, old_path))
+            conn.execute('UPDATE images SET file_path = ? WHERE file_path = ?', (new_path, old_path))
+            conn.execute('UPDATE images SET media_path = ? WHERE media_path = ?', (new_path, old_path))
+            conn.execute('UPDATE image_derivatives SET path = ? WHERE path = ?', (new_path, old_path))
+
+    def set_image_blob(self, image_id, content_hash, blob_path):
+        """Point an image at its shared blob; returns the files it used to use"""
+        with self.pool.transaction() as conn:
+            old = conn.execute(
+                'SELECT file_path, media_path FROM images WHERE id = ?', (image_id,)
+            ).fetchone()
+            conn.execute('''
+                UPDATE images SET content_hash = ?, file_path = ?, media_path = ?
+                WHERE id = ?
+            ''', (content_hash, blob_path, blob_path, image_id))
+            self._bump_data_version(conn, 'SELECT username FROM images WHERE id = ?', (image_id,))
+        return {old['file_path'], old['media_path']} - {blob_path} if old else set()
@@ -0,0 +1,73 @@
+"""Background deletion of auto-expiring images.
+
+One ExpiryWorker runs per server process, but only the process holding
+the ``expiry`` lease does any work, so a deployment deletes each image
+exactly once. The worker sleeps until the next ``expires_at`` (read from
+the partial index), never longer than ``max_sleep`` so it notices uploads
+made by other processes. Run ``python expiry.py`` to host it in a
+dedicated process instead of inside the Streamlit server.
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime
+
+from database import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = "expiry"
+
+
+class ExpiryWorker(threading.Thread):
+    def __init__(self, db=None, batch_size=500, max_sleep=30.0, lease_ttl=90.0):
+        super().__init__(name="expiry-worker", daemon=True)
+        self.db = db or DatabaseManager()
+        self.batch_size = batch_size
+        self.max_sleep = max_sleep
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        self.join(timeout)
+
+    def run(self):
+        try:
+            while not self._stopping.is_set():
+                self._wakeup.wait(self.run_once())
+                self._wakeup.clear()
+        finally:
+            self.db.release_lease(LEASE_NAME, self.owner)
+
+    def run_once(self):
+        """Delete everything that is due; returns seconds until the next check"""
+        try:
+            if not self.db.acquire_lease(LEASE_NAME, self.owner, self.lease_ttl):
+                return self.max_sleep
+            while self.db.delete_expired_batch(datetime.now(), self.batch_size) == self.batch_size:
+                if self._stopping.is_set():
+                    return 0
+            next_expiry = self.db.get_next_expiry()
+        except Exception:
+            logger.exception("Expiry sweep failed")
+            return self.max_sleep
+
+        if next_expiry is None:
+            return self.max_sleep
+        return min(max((next_expiry - datetime.now()).total_seconds(), 0.05), self.max_sleep)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    worker = ExpiryWorker()
+    worker.start()
+    try:
+        worker.join()
+    except KeyboardInterrupt:
+        worker.stop()
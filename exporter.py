@@ -0,0 +1,107 @@
+"""Streaming ZIP export of a user's images.
+
+``stream_export`` yields the archive as a sequence of byte chunks, read
+straight from the blob store, so nothing ever holds more than one chunk
+of any file. Already-compressed formats are stored as-is; only formats
+that gain from it are deflated. The archive ends with ``manifest.csv`` and
+``manifest.json`` describing the exported rows, which are likewise read
+from the database a batch at a time. media_server.py serves exports at
+``/export/<id>`` so large downloads never run inside the Streamlit process.
+"""
+import csv
+import io
+import json
+import os
+import zipfile
+from datetime import datetime
+
+from locations import download_name
+
+EXPORT_CHUNK_SIZE = 256 * 1024
+# Recompressing these only burns CPU
+STORED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+MANIFEST_COLUMNS = (
+    'id', 'filename', 'original_name', 'archive_path', 'file_size', 'image_format',
+    'width', 'height', 'upload_time', 'expires_at', 'views', 'content_hash',
+)
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to the generator"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def archive_path(image):
+    # The id prefix keeps names unique without remembering what was written
+    name = os.path.basename(download_name(image).replace('\\', '/')) or image['filename']
+    return f"images/{image['id']}-{name}"
+
+
+def export_filename(now=None):
+    return f"imagehub-export-{(now or datetime.now()):%Y%m%d-%H%M%S}.zip"
+
+
+def _manifest_row(image):
+    return {column: image.get(column) for column in MANIFEST_COLUMNS}
+
+
+def stream_export(db, username, filenames=None):
+    """Yield the export ZIP for ``username`` (optionally only ``filenames``) in chunks"""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as archive:
+        for image in db.iter_export_images(username, filenames):
+            try:
+                source = open(image['file_path'], 'rb')
+            except OSError:
+                continue
+            with source:
+                info = zipfile.ZipInfo(archive_path(image), datetime.now().timetuple()[:6])
+                extension = image['file_extension'].lower()
+                info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                # A known size lets zipfile pick zip64 headers up front when needed
+                info.file_size = os.fstat(source.fileno()).st_size
+                with archive.open(info, 'w') as entry:
+                    for chunk in iter(lambda: source.read(EXPORT_CHUNK_SIZE), b''):
+                        entry.write(chunk)
+                        yield sink.drain()
+            yield sink.drain()
+
+        with archive.open('manifest.csv', 'w') as entry:
+            text = io.TextIOWrapper(entry, encoding='utf-8', newline='')
+            writer = csv.DictWriter(text, fieldnames=MANIFEST_COLUMNS)
+            writer.writeheader()
+            for image in db.iter_export_images(username, filenames):
+                writer.writerow(_manifest_row({**image, 'archive_path': archive_path(image)}))
+                text.flush()
+                yield sink.drain()
+            text.detach()
+
+        with archive.open('manifest.json', 'w') as entry:
+            entry.write(b'[\n')
+            separator = b''
+            for image in db.iter_export_images(username, filenames):
+                row = _manifest_row({**image, 'archive_path': archive_path(image)})
+                entry.write(separator + json.dumps(row, default=str).encode())
+                separator = b',\n'
+                yield sink.drain()
+            entry.write(b'\n]\n')
+    yield sink.drain()
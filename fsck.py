@@ -0,0 +1,156 @@
+"""Storage reconciliation: orphaned files and rows whose files are gone.
+
+StorageChecker walks the storage directories in a fixed (sorted) order,
+a batch of files at a time, and remembers how far it got in
+``maintenance_cursors`` so a pass survives restarts. Each batch is checked
+against ``images.file_path``/``media_path`` and ``image_derivatives.path``
+with indexed IN queries. Files a queued ``release-files`` job will remove
+count as referenced, so a replaced blob keeps its RELEASE_DELAY grace, and
+the blob store's ``.tmp`` staging area is never walked. Orphans must also
+be older than ``min_age``, and are re-checked and removed inside a write
+transaction: an upload that reuses the same blob either commits first
+(and the file is kept) or sees it gone and writes it again, exactly as
+with image deletes. That makes it safe to leave running against a live
+deployment.
+"""
+import logging
+import os
+import shutil
+import time
+from itertools import islice
+
+from database import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_DIR = "user_data/quarantine"
+# static/media holds the blob store; user_images is the pre-blob-store layout
+STORAGE_ROOTS = ("static/media", "user_images")
+# BlobStore staging: uploads and re-encodes still being written
+SKIP_DIRS = {".tmp"}
+FILES_CURSOR = "fsck-files"
+ROWS_CURSOR = "fsck-rows"
+ACTIONS = ("report", "quarantine", "delete")
+
+
+def _key(path):
+    return os.path.normpath(path).split(os.sep)
+
+
+def iter_files(root, after=None):
+    """Yield every file under ``root`` in sorted order, starting past ``after``"""
+    after_key = _key(after) if after else None
+    try:
+        entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        key = _key(entry.path)
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name in SKIP_DIRS:
+                continue
+            # Skip whole subtrees that sort entirely before the cursor
+            if after_key and key < after_key[:len(key)]:
+                continue
+            inside = after_key and after_key[:len(key)] == key
+            yield from iter_files(entry.path, after if inside else None)
+        elif entry.is_file(follow_symlinks=False):
+            if after_key is None or key > after_key:
+                yield entry.path
+
+
+class StorageChecker:
+    def __init__(self, db=None, roots=STORAGE_ROOTS, action="report", min_age=3600,
+                 quarantine_dir=QUARANTINE_DIR):
+        if action not in ACTIONS:
+            raise ValueError(f"action must be one of {', '.join(ACTIONS)}")
+        self.db = db or DatabaseManager()
+        self.roots = list(roots)
+        self.action = action
+        self.min_age = min_age
+        self.quarantine_dir = quarantine_dir
+
+    def _iter_all_files(self, after):
+        started = after is None
+        for root in self.roots:
+            inside = after is not None and _key(after)[:len(_key(root))] == _key(root)
+            if inside:
+                started = True
+                yield from iter_files(root, after)
+            elif started:
+                yield from iter_files(root)
+
+    def check_files(self, batch_size=500):
+        """Check the next batch of files; returns a report dict.
+
+        ``report['done']`` is True once the pass has covered every root; the
+        next call then starts a fresh pass.
+        """
+        cursor = self.db.get_cursor(FILES_CURSOR)
+        paths = list(islice(self._iter_all_files(cursor), batch_size))
+        report = {'scanned': len(paths), 'orphans': 0, 'bytes': 0, 'young': 0, 'done': not paths}
+        if not paths:
+            self.db.set_cursor(FILES_CURSOR, None)
+            return report
+
+        referenced = self.db.get_referenced_paths(paths) | self.db.get_pending_release_paths(paths)
+        now = time.time()
+        for path in paths:
+            if path in referenced:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime < self.min_age:
+                # Possibly an upload between writing its file and its row
+                report['young'] += 1
+                continue
+            if self._collect(path):
+                report['orphans'] += 1
+                # Hard links from the dedupe migration free nothing until the last goes
+                if stat.st_nlink == 1:
+                    report['bytes'] += stat.st_size
+
+        self.db.set_cursor(FILES_CURSOR, paths[-1])
+        return report
+
+    def _in_use(self, path):
+        return self.db.is_path_referenced(path) or bool(self.db.get_pending_release_paths([path]))
+
+    def _collect(self, path):
+        """Quarantine/remove ``path`` if it is still unreferenced; True if it was"""
+        if self.action == "report":
+            return not self._in_use(path)
+        with self.db.pool.transaction():
+            # A re-encode may have swapped the row over since the batch query
+            if self._in_use(path):
+                return False
+            try:
+                if self.action == "delete":
+                    os.remove(path)
+                else:
+                    target = os.path.join(self.quarantine_dir, os.path.normpath(path).lstrip(os.sep))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+            except FileNotFoundError:
+                return False
+        logger.info("%s orphan %s", "Removed" if self.action == "delete" else "Quarantined", path)
+        return True
+
+    def check_rows(self, batch_size=500, prune=False):
+        """Check the next batch of images for missing files; returns a report dict"""
+        after_id = int(self.db.get_cursor(ROWS_CURSOR) or 0)
+        batch = self.db.get_image_paths(after_id, batch_size)
+        report = {'scanned': len(batch), 'missing': [], 'done': not batch}
+        if not batch:
+            self.db.set_cursor(ROWS_CURSOR, None)
+            return report
+
+        for image in batch:
+            if not os.path.isfile(image['file_path']):
+                report['missing'].append(image['id'])
+        if prune and report['missing']:
+            self.db.delete_images(report['missing'])
+        self.db.set_cursor(ROWS_CURSOR, str(batch[-1]['id']))
+        return report
@@ -0,0 +1,242 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from database import GALLERY_PAGE_SIZE, DatabaseManager
+from imaging import check_limits, probe_image
+from similarity import DUPLICATE_DISTANCE, SIMILAR_DISTANCE
+from transcoding import get_policy
+from locations import LocationIndex, content_version, location_from_row
+from signing import LinkSigner
+from storage import BlobStore
+
+# Where media_server.py is reachable from the browser
+MEDIA_SERVER_URL = os.environ.get("MEDIA_SERVER_URL", "http://localhost:8502")
+# How long an export download link stays valid
+EXPORT_LINK_TTL = 24 * 3600
+# Threads used to hash, validate and derive a multi-file upload
+UPLOAD_WORKERS = min(8, (os.cpu_count() or 2) * 2)
+
+
+class ImageManager:
+    def __init__(self, db=None, storage=None, locations=None, signer=None, policy=None):
+        self.db = db or DatabaseManager()
+        self.storage = storage or BlobStore()
+        self.locations = locations or LocationIndex(self.db)
+        self.signer = signer or LinkSigner()
+        self.policy = policy or get_policy()
+    
+    def save_image(self, username, uploaded_file, auto_delete_hours=0):
+        # Thumbnails are made by worker.py; this returns once the row is in
+        image_data, temp_path = self._stage(uploaded_file, auto_delete_hours)
+        self._commit(username, [(image_data, temp_path)])
+        return image_data
+    
+    def save_images(self, username, uploaded_files, auto_delete_hours=0,
+                    progress_callback=None, max_workers=UPLOAD_WORKERS, on_commit=None):
+        """Save a batch of uploads in parallel, committing all rows together.
+        
+        Hashing and validation run on a thread pool (hashlib releases the
+        GIL); derivatives are queued for worker.py. Calls
+        ``progress_callback(fraction)`` from the calling thread as work
+        finishes, and ``on_commit(saved)`` inside the transaction that
+        inserts the rows. Returns ``(saved image_data list, [(name, error), ...])``.
+        """
+        total_steps = max(len(uploaded_files), 1)
+        done = 0
+        staged, failed = [], []
+        
+        def report():
+            if progress_callback:
+                progress_callback(done / total_steps)
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(self._stage, f, auto_delete_hours): i for i, f in enumerate(uploaded_files)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    staged.append((index, future.result()))
+                except Exception as e:
+                    failed.append((index, (uploaded_files[index].name, e)))
+                done += 1
+                report()
+        
+        # Rows (and so ids and gallery order) follow the user's selection,
+        # not whichever file finished staging first
+        staged = [result for _, result in sorted(staged, key=lambda item: item[0])]
+        failed = [error for _, error in sorted(failed, key=lambda item: item[0])]
+        if not staged:
+            return [], failed
+        self._commit(username, staged, on_commit)
+        return [image_data for image_data, _ in staged], failed
+    
+    def _stage(self, uploaded_file, auto_delete_hours):
+        """Hash the upload into a temp file and check it really is an image"""
+        file_extension = uploaded_file.name.split('.')[-1].lower()
+        unique_id = uuid.uuid4().hex[:16]
+        filename = f"{unique_id}.{file_extension}"
+        
+        content_hash, temp_path, file_size = self.storage.stage(uploaded_file)
+        try:
+            # Header only: oversized images are turned away before any decode
+            metadata = probe_image(temp_path)
+            check_limits(metadata)
+        except ValueError:
+            self.storage.discard(temp_path)
+            raise
+        
+        expires_at = None
+        if auto_delete_hours > 0:
+            expires_at = datetime.now() + timedelta(hours=auto_delete_hours)
+        
+        image_data = {
+            'filename': filename,
+            'original_name': uploaded_file.name,
+            'file_size': file_size,
+            'file_extension': file_extension,
+            'delete_key': uuid.uuid4().hex[:12],
+            'auto_delete_hours': auto_delete_hours,
+            'expires_at': expires_at,
+            'content_hash': content_hash,
+            **metadata
+        }
+        if not self.policy.rule_for(metadata['image_format']):
+            # Nothing to re-encode; `manage.py transcode` can skip it
+            image_data['transcode_policy'] = self.policy.tag
+        return image_data, temp_path
+    
+    def _commit(self, username, staged, on_commit=None):
+        """Move staged files into the blob store and insert all rows in one transaction"""
+        try:
+            with self.db.pool.transaction():
+                for image_data, temp_path in staged:
+                    # The per-user path and the served path are both the shared blob
+                    blob_path, was_created = self.storage.commit(
+                        temp_path, image_data['content_hash'], image_data['file_extension']
+                    )
+                    image_data['file_path'] = image_data['media_path'] = blob_path
+                    image_data['id'] = self.db.save_image(username, image_data)
+                    self._queue_processing(image_data, was_created)
+                if on_commit:
+                    on_commit([image_data for image_data, _ in staged])
+        except BaseException:
+            for _, temp_path in staged:
+                self.storage.discard(temp_path)
+            raise
+        for image_data, _ in staged:
+            self.locations.put(location_from_row({**image_data, 'username': username}))
+    
+    def _queue_processing(self, image_data, created):
+        if 'transcode_policy' not in image_data:
+            # The transcode job also makes the derivatives, from the re-encoded file
+            self.db.enqueue_job('transcode', image_id=image_data['id'])
+            return
+        # Bytes we already had come with thumbnails; new ones go to the job queue
+        derivatives = [] if created else self.db.get_derivatives_by_hash(image_data['content_hash'])
+        if derivatives:
+            self.db.save_derivatives(image_data['id'], derivatives)
+            # No job runs to hash it, but the same bytes have the same hash
+            self.db.copy_image_hash(image_data['id'], image_data['content_hash'])
+        else:
+            self.db.enqueue_job('derivatives', image_id=image_data['id'])
+    
+    def get_processing_images(self, image_ids):
+        return self.db.get_processing_images(image_ids)
+    
+    def get_user_images(self, username):
+        return self.db.get_user_images(username)
+    
+    def get_user_images_page(self, username, after_cursor=None, limit=GALLERY_PAGE_SIZE):
+        return self.db.get_user_images_page(username, after_cursor, limit)
+    
+    def search_images(self, username, after_cursor=None, limit=GALLERY_PAGE_SIZE, **filters):
+        return self.db.search_images(username, after_cursor=after_cursor, limit=limit, **filters)
+    
+    def find_similar_images(self, username, image_id, max_distance=SIMILAR_DISTANCE, limit=GALLERY_PAGE_SIZE):
+        """The user's other images that look like ``image_id``, nearest first"""
+        phash = self.db.get_image_hash(username, image_id)
+        if phash is None:
+            return []
+        return self.db.find_similar_images(username, phash, max_distance, exclude_id=image_id, limit=limit)
+    
+    def find_duplicates(self, username, phash, limit=3):
+        """Images the user already has that an upload with ``phash`` would duplicate"""
+        return self.db.find_similar_images(username, phash, DUPLICATE_DISTANCE, limit=limit)
+    
+    def get_user_stats(self, username):
+        return self.db.get_user_stats(username)
+    
+    def get_derivatives(self, image_ids):
+        return self.db.get_derivatives(image_ids)
+    
+    def delete_image(self, username, filename):
+        # Ownership is settled from the location index without a query
+        location = self.locations.get(filename)
+        if location is None or location.owner != username:
+            return False
+        # Files go with the row, and only once nothing else references them
+        deleted = self.db.delete_image(username, filename)
+        self.locations.discard(filename)
+        return deleted
+    
+    def get_image_url(self, image_data, ttl=None):
+        """Signed shareable link, served by media_server.py rather than Streamlit"""
+        return self._signed_url("media", image_data, ttl)
+    
+    def get_download_url(self, image_data, ttl=None):
+        """Signed link to the streaming download endpoint of media_server.py"""
+        return self._signed_url("download", image_data, ttl)
+    
+    def create_export(self, username, filenames=None, ttl=EXPORT_LINK_TTL):
+        """Signed link to a streaming ZIP of the given images (all of them if None)"""
+        export_id = self.db.create_export(username, filenames)
+        expires = self.signer.link_expiry(ttl=ttl)
+        return f"{MEDIA_SERVER_URL}/export/{export_id}?{self.signer.sign(f'export/{export_id}', expires)}"
+    
+    def _signed_url(self, route, image_data, ttl):
+        # A link never outlives its image; ``ttl`` (seconds) can cut it shorter
+        expires_at = image_data.get('expires_at')
+        if isinstance(expires_at, str):
+            expires_at = datetime.fromisoformat(expires_at)
+        expires = self.signer.link_expiry(expires_at, ttl)
+        filename = image_data['filename']
+        url = f"{MEDIA_SERVER_URL}/{route}/{filename}?{self.signer.sign(filename, expires)}"
+        # Names the bytes, so caches may keep them for good (see media_server.py)
+        version = content_version(image_data.get('content_hash'))
+        return f"{url}&v={version}" if version else url
+    
+    def format_file_size(self, size_bytes):
+        """Convert file size to human readable format"""
+        if size_bytes == 0:
+            return "0 B"
+        size_names = ["B", "KB", "MB", "GB"]
+        i = 0
+        while size_bytes >= 1024 and i < len(size_names)-1:
+            size_bytes /= 1024.0
+            i += 1
+        return f"{size_bytes:.1f} {size_names[i]}"
+    
+    def format_time_remaining(self, expires_at):
+        """Format time remaining until expiration"""
+        if not expires_at:
+            return "Never"
+        
+        if isinstance(expires_at, str):
+            expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+        
+        now = datetime.now()
+        if expires_at < now:
+            return "Expired"
+        
+        delta = expires_at - now
+        days = delta.days
+        hours = int(delta.seconds // 3600)
+        minutes = int((delta.seconds % 3600) // 60)
+        
+        if days > 0:
+            return f"{days}d {hours}h"
+        elif hours > 0:
+            return f"{hours}h {minutes}m"
+        else:
+            return f"{minutes}m"
@@ -0,0 +1,312 @@
+import io
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+from PIL import Image, ImageOps
+
+# Derivative kinds and their bounding box (longest edge, in pixels)
+DERIVATIVE_SIZES = {
+    'thumb': 480,
+    'medium': 1280,
+}
+# Also write a WebP copy of every derivative
+WEBP_DERIVATIVES = True
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+EXIF_ORIENTATION = 0x0112
+# Formats whose getexif() only reads what Image.open already parsed; PNG's
+# decodes the whole image to look for an eXIf chunk after the pixel data
+HEADER_EXIF_FORMATS = {'JPEG', 'MPO', 'WEBP', 'TIFF'}
+
+# Decoding limits. Anything over MAX_IMAGE_PIXELS is rejected from its
+# header; a decode whose buffer (after draft scaling) would exceed
+# MAX_DECODE_BYTES is refused; and only LARGE_DECODE_SLOTS decodes over
+# LARGE_DECODE_PIXELS run at once per process, so a burst of big PNGs
+# queues instead of multiplying peak memory.
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 100_000_000))
+MAX_DECODE_BYTES = int(os.environ.get("MAX_DECODE_BYTES", 512 * 1024 * 1024))
+LARGE_DECODE_PIXELS = 16_000_000
+LARGE_DECODE_SLOTS = int(os.environ.get("LARGE_DECODE_SLOTS", 2))
+# Animations are also capped on frames × pixels: each frame is a full decode
+MAX_ANIMATION_PIXELS = int(os.environ.get("MAX_ANIMATION_PIXELS", 1_000_000_000))
+_large_decodes = threading.BoundedSemaphore(LARGE_DECODE_SLOTS)
+
+# Pillow's own bomb check (an error at twice this) as a backstop
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def check_limits(metadata):
+    """Raise ImageTooLarge if probed metadata is over the pixel budgets"""
+    pixels = metadata['width'] * metadata['height']
+    if pixels > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(
+            f"{metadata['width']}×{metadata['height']} is over the "
+            f"{MAX_IMAGE_PIXELS / 1_000_000:g} megapixel limit"
+        )
+    frames = metadata.get('frame_count') or 1
+    if pixels * frames > MAX_ANIMATION_PIXELS:
+        raise ImageTooLarge(
+            f"{frames} frames of {metadata['width']}×{metadata['height']} are over the "
+            f"{MAX_ANIMATION_PIXELS / 1_000_000:g} megapixel animation limit"
+        )
+
+
+def _decoded_bytes(image):
+    # Pillow keeps 1-byte modes as-is and pads everything else to 4 bytes a pixel
+    return image.width * image.height * (1 if image.mode in ('1', 'L', 'P') else 4)
+
+
+@contextmanager
+def open_bounded(source, box=None):
+    """Open and decode ``source`` within the decoding limits.
+
+    With ``box``, JPEGs decode at the smallest DCT scale (1/2, 1/4, 1/8)
+    that still covers it, so a 50MP photo never exists at full size.
+    Raises ImageTooLarge before decoding anything over the limits.
+    """
+    with Image.open(source) as image:
+        check_limits({'width': image.width, 'height': image.height,
+                      'frame_count': getattr(image, 'n_frames', 1)})
+        if box:
+            image.draft('RGB', box)
+        if _decoded_bytes(image) > MAX_DECODE_BYTES:
+            raise ImageTooLarge(f"Decoding {image.width}×{image.height} {image.mode} needs too much memory")
+        large = image.width * image.height > LARGE_DECODE_PIXELS
+        if large:
+            _large_decodes.acquire()
+        try:
+            image.load()
+            yield image
+        finally:
+            if large:
+                _large_decodes.release()
+
+
+def probe_image(source, limits=True):
+    """Read an image's metadata from its header, without decoding pixels.
+
+    ``source`` is a path or file object. Returns the columns stored on
+    ``images`` (image_format, width, height, color_mode, frame_count,
+    orientation); raises ValueError if Pillow can't identify the file, and
+    (unless ``limits`` is False) ImageTooLarge as soon as the header shows it
+    is over MAX_IMAGE_PIXELS.
+    """
+    try:
+        with Image.open(source) as image:
+            # Before anything else touches the file: dimensions alone settle it
+            if limits:
+                check_limits({'width': image.width, 'height': image.height})
+            metadata = {
+                'image_format': image.format,
+                'width': image.width,
+                'height': image.height,
+                'color_mode': image.mode,
+                # Counting GIF/WebP frames walks block headers; nothing is decoded
+                'frame_count': getattr(image, 'n_frames', 1),
+                'orientation': _header_orientation(image),
+                'duration_ms': None,
+            }
+        if metadata['frame_count'] > 1:
+            metadata['duration_ms'] = animation_duration(source, metadata['image_format'])
+        return metadata
+    # Truncated or corrupt files also fail with whatever a plugin's header or
+    # frame walk trips over: IndexError from a GIF's n_frames, KeyError and
+    # TypeError from TIFF tags
+    except (OSError, EOFError, IndexError, KeyError, TypeError, SyntaxError, struct.error,
+            Image.DecompressionBombError) as e:
+        raise ValueError(f"Not a supported image: {e}") from e
+
+
+def _header_orientation(image):
+    if image.format in HEADER_EXIF_FORMATS:
+        exif = image.getexif()
+    else:
+        exif = Image.Exif()
+        if image.info.get('exif'):
+            exif.load(image.info['exif'])
+    return exif.get(EXIF_ORIENTATION, 1)
+
+
+def animation_duration(source, image_format):
+    """Total play time of an animated GIF/WebP in ms, read from block headers.
+
+    Pillow only reports a frame's duration once it has decoded it, which
+    for a long GIF costs far more than the upload itself. Returns None for
+    other formats.
+    """
+    scanner = {'GIF': _gif_delays, 'WEBP': _webp_delays}.get(image_format)
+    if scanner is None:
+        return None
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return sum(scanner(f))
+    position = source.tell()
+    source.seek(0)
+    try:
+        return sum(scanner(source))
+    finally:
+        source.seek(position)
+
+
+def _skip_sub_blocks(f):
+    while True:
+        size = f.read(1)
+        if not size or size[0] == 0:
+            return
+        f.seek(size[0], os.SEEK_CUR)
+
+
+def _gif_delays(f):
+    header = f.read(13)
+    flags = header[10]
+    if flags & 0x80:
+        f.seek(3 << ((flags & 7) + 1), os.SEEK_CUR)  # global colour table
+    delay = 0
+    while True:
+        introducer = f.read(1)
+        if introducer == b'!':
+            label = f.read(1)
+            if label == b'\xf9':
+                # Graphic control extension: the delay of the next frame, in 1/100 s
+                block = f.read(5)
+                delay = struct.unpack('<H', block[2:4])[0]
+            _skip_sub_blocks(f)
+        elif introducer == b',':
+            descriptor = f.read(9)
+            if descriptor[8] & 0x80:
+                f.seek(3 << ((descriptor[8] & 7) + 1), os.SEEK_CUR)  # local colour table
+            f.seek(1, os.SEEK_CUR)  # LZW code size
+            _skip_sub_blocks(f)
+            # Browsers play 0 and 1 as 1/10 s, so count them that way too
+            yield 100 if delay <= 1 else delay * 10
+            delay = 0
+        else:
+            return  # trailer, or a truncated file
+
+
+def _webp_delays(f):
+    f.seek(12)  # RIFF header
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        fourcc, size = header[:4], struct.unpack('<I', header[4:])[0]
+        if fourcc == b'ANMF':
+            frame = f.read(16)
+            yield int.from_bytes(frame[12:15], 'little')
+            f.seek(size - 16 + (size & 1), os.SEEK_CUR)
+        else:
+            f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def perceptual_hash(source):
+    """64-bit difference hash (dHash) of ``source``, as an unsigned int.
+
+    Each bit says whether a pixel of a 9×8 greyscale copy is brighter
+    than its right-hand neighbour, so the hash survives resizing,
+    recompression and format changes. JPEGs decode at 1/8 scale for it.
+    """
+    with open_bounded(source, (64, 64)) as image:
+        image = ImageOps.exif_transpose(image)
+        pixels = image.convert('L').resize((9, 8), Image.LANCZOS, reducing_gap=3.0).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def display_size(width, height, orientation):
+    """Width and height as shown, after applying the EXIF orientation"""
+    if orientation in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+
+def preview_bytes(source, size=160):
+    """Small JPEG/PNG of ``source``, for upload previews and cards without derivatives"""
+    with open_bounded(source, (size, size)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        out = io.BytesIO()
+        if has_alpha(image):
+            image.convert('RGBA').save(out, 'PNG')
+        else:
+            image.convert('RGB').save(out, 'JPEG', quality=80)
+        return out.getvalue()
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def generate_derivatives(source_path, output_dir, stem, webp=WEBP_DERIVATIVES):
+    """Write downscaled copies of ``source_path`` next to it.
+
+    Returns one dict per file written (kind, format, path, width, height,
+    file_size). Sizes the original already fits inside are skipped.
+    Animations also get a ``poster``: their first frame, still, at up to
+    the largest size, so nothing has to play them to show a card.
+    """
+    derivatives = []
+    # Decode straight at (roughly) the largest size we need
+    largest = max(DERIVATIVE_SIZES.values())
+    with open_bounded(source_path, (largest, largest)) as source:
+        animated = getattr(source, 'is_animated', False)
+        image = ImageOps.exif_transpose(source)
+        alpha = has_alpha(image)
+        image = image.convert('RGBA' if alpha else 'RGB')
+
+        formats = [('png', 'PNG', {'optimize': True}) if alpha
+                   else ('jpg', 'JPEG', {'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True})]
+        if webp:
+            formats.append(('webp', 'WEBP', {'quality': WEBP_QUALITY, 'method': 4}))
+
+        def save(kind, image):
+            for extension, pil_format, options in formats:
+                path = os.path.join(output_dir, f"{stem}_{kind}.{extension}")
+                image.save(path, pil_format, **options)
+                derivatives.append({
+                    'kind': kind,
+                    'format': extension,
+                    'path': path,
+                    'width': image.width,
+                    'height': image.height,
+                    'file_size': os.path.getsize(path),
+                })
+
+        if animated:
+            poster = image.copy()
+            poster.thumbnail((largest, largest), Image.LANCZOS)
+            save('poster', poster)
+
+        for kind, size in sorted(DERIVATIVE_SIZES.items(), key=lambda item: -item[1]):
+            if max(image.size) <= size:
+                continue
+            image.thumbnail((size, size), Image.LANCZOS)
+            save(kind, image)
+    return derivatives
+
+
+def pick_derivative(derivatives, target_width, prefer_webp=WEBP_DERIVATIVES):
+    """Smallest derivative at least ``target_width`` wide, else the largest one.
+
+    Returns None when there are no derivatives and the original should be
+    shown instead.
+    """
+    webp = [d for d in derivatives if d['format'] == 'webp']
+    candidates = webp if prefer_webp and webp else [d for d in derivatives if d['format'] != 'webp']
+    if not candidates:
+        return None
+    candidates.sort(key=lambda d: d['width'])
+    for derivative in candidates:
+        if derivative['width'] >= target_width:
+            return derivative
+    return candidates[-1]
@@ -0,0 +1,171 @@
+"""Bulk import of images from ZIP and TAR archives.
+
+Entries are streamed out of the archive and fed through
+ImageManager.save_images in batches of ``batch_size``, so memory stays flat
+however large the album is: ZIP members are opened lazily by the upload
+workers, and TAR members (which can only be read in order) are spooled to
+small temp files. Each batch's progress is recorded in ``archive_imports``
+inside the transaction that commits its images, so an interrupted import
+of the same archive picks up exactly where it stopped.
+"""
+import os
+import tarfile
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+
+from storage import new_hasher
+
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp')
+ARCHIVE_EXTENSIONS = ('zip', 'tar', 'tgz', 'gz', 'bz2', 'xz')
+IMPORT_BATCH_SIZE = 50
+# TAR members larger than this go to disk while they wait for their batch
+SPOOL_BYTES = 1024 * 1024
+FINGERPRINT_BYTES = 1024 * 1024
+# Largest archive the app imports: Streamlit holds an upload in memory and
+# the import runs in the request, so bigger albums go through
+# ``manage.py import-archive``
+MAX_APP_ARCHIVE_BYTES = int(os.environ.get("MAX_APP_ARCHIVE_BYTES", 100 * 1024 * 1024))
+
+
+class ArchiveMember:
+    """File-like view of one archive entry, opened on first read"""
+
+    def __init__(self, name, opener):
+        self.name = name
+        self._opener = opener
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = self._opener()
+        return self._file
+
+    def read(self, size=-1):
+        return self._open().read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._open().seek(offset, whence)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def is_importable(path_in_archive):
+    name = os.path.basename(path_in_archive)
+    if not name or name.startswith('.') or '__MACOSX/' in path_in_archive:
+        return False
+    return name.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS
+
+
+def archive_fingerprint(path):
+    """Identifies an archive across uploads: size plus a hash of its first MiB"""
+    hasher = new_hasher()
+    with open(path, 'rb') as f:
+        hasher.update(f.read(FINGERPRINT_BYTES))
+    return f"{os.path.getsize(path)}:{hasher.hexdigest()}"
+
+
+@contextmanager
+def open_archive(path):
+    """Open a ZIP, or a (possibly compressed) TAR in stream mode"""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            yield archive
+    elif tarfile.is_tarfile(path):
+        # Stream mode: members are read strictly in order, never all listed up front
+        with tarfile.open(path, 'r|*') as archive:
+            yield archive
+    else:
+        raise ValueError("Not a ZIP or TAR archive")
+
+
+def iter_members(archive, skip=0):
+    """Yield ``(position, member or None)`` for every entry after the first ``skip``.
+
+    ``member`` is None for entries that are not images (directories,
+    metadata files...); they still count towards ``position``. Members
+    stay readable until the archive is closed.
+    """
+    if isinstance(archive, zipfile.ZipFile):
+        infos = archive.infolist()
+        for position in range(skip, len(infos)):
+            info = infos[position]
+            member = None
+            if not info.is_dir() and is_importable(info.filename):
+                member = ArchiveMember(os.path.basename(info.filename),
+                                       lambda info=info: archive.open(info))
+            yield position, member
+        return
+
+    for position, info in enumerate(archive):
+        if position < skip:
+            continue
+        if not info.isfile() or not is_importable(info.name):
+            yield position, None
+            continue
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        source = archive.extractfile(info)
+        for chunk in iter(lambda: source.read(SPOOL_BYTES), b''):
+            spool.write(chunk)
+        spool.seek(0)
+        yield position, ArchiveMember(os.path.basename(info.name), lambda spool=spool: spool)
+
+
+def import_archive(image_manager, username, path, archive_name=None, auto_delete_hours=0,
+                   batch_size=IMPORT_BATCH_SIZE, progress_callback=None, error_callback=None):
+    """Import every image in the archive at ``path``, resuming a previous attempt.
+
+    Calls ``progress_callback(record)`` after each batch and
+    ``error_callback(name, error)`` for each entry that could not be saved.
+    Returns the ``archive_imports`` record with the final totals.
+    """
+    db = image_manager.db
+    record = db.get_archive_import(username, archive_fingerprint(path),
+                                   archive_name or os.path.basename(path))
+    if record['completed_at']:
+        return record
+
+    batch = []
+
+    def flush(end, completed=False):
+        committed, failed = [], []
+
+        def on_commit(saved):
+            committed.append(saved)
+            db.record_import_progress(record['id'], end, len(saved), len(batch) - len(saved), completed)
+
+        try:
+            if batch:
+                _, failed = image_manager.save_images(username, batch, auto_delete_hours, on_commit=on_commit)
+        finally:
+            for member in batch:
+                member.close()
+        if not committed:
+            # Nothing in the batch was saved, so no transaction recorded it
+            db.record_import_progress(record['id'], end, 0, len(batch), completed)
+        if error_callback:
+            for name, error in failed:
+                error_callback(name, error)
+        saved_count = len(committed[0]) if committed else 0
+        record['position'] = end
+        record['imported'] += saved_count
+        record['failed'] += len(batch) - saved_count
+        if completed:
+            record['completed_at'] = datetime.now()
+        batch.clear()
+        if progress_callback:
+            progress_callback(record)
+
+    end = record['position']
+    with open_archive(path) as archive:
+        for position, member in iter_members(archive, skip=end):
+            end = position + 1
+            if member is not None:
+                batch.append(member)
+            if len(batch) >= batch_size:
+                flush(end)
+        flush(end, completed=True)
+    return record
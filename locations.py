@@ -0,0 +1,98 @@
+"""In-memory filename -> location index for the serving path.
+
+Serving a shared link or deleting an image only needs to know where a
+filename lives, how big it is, who owns it and when it expires. A
+LocationIndex keeps those facts for hot filenames in a bounded LRU so
+repeat hits resolve with a dict lookup and no SQLite access. It is warmed
+with the most recent uploads at startup and updated by this process's own
+uploads and deletes; the TTL bounds how long a change made by another
+process (e.g. a delete in the Streamlit app seen by the media server) can
+go unnoticed. Expiry needs no invalidation: ``expires_at`` travels with the
+entry and callers check it on every hit.
+"""
+import mimetypes
+import os
+from collections import namedtuple
+from datetime import datetime
+
+from cache import LRUCache
+
+# Rough per-entry footprint; entries are small and uniform, so the LRU
+# bound is effectively an entry count
+ENTRY_SIZE = 512
+# Hex digits of the content hash put in media URLs (``v=``); a link minted
+# after re-encoding replaced the file differs from one minted before
+VERSION_LENGTH = 12
+
+Location = namedtuple('Location', 'filename path size mime expires_at owner content_hash download_name')
+
+
+def content_version(content_hash):
+    return content_hash[:VERSION_LENGTH] if content_hash else None
+
+
+def download_name(row):
+    """The uploaded name, with the extension of the stored format if re-encoding changed it"""
+    name = row.get('original_name') or row['filename']
+    original_format = row.get('original_format')
+    if original_format and original_format != row.get('image_format') and row.get('file_extension'):
+        name = f"{os.path.splitext(name)[0]}.{row['file_extension']}"
+    return name
+
+
+def location_from_row(row):
+    """Build a Location from a LOCATION_COLUMNS row or an image_data dict"""
+    expires_at = row.get('expires_at')
+    if isinstance(expires_at, str):
+        expires_at = datetime.fromisoformat(expires_at)
+    filename = row['filename']
+    # Go by the stored file: re-encoding can change the format under the same name
+    mime = mimetypes.guess_type(row['file_path'])[0] or mimetypes.guess_type(filename)[0]
+    return Location(
+        filename=filename,
+        path=row['file_path'],
+        size=row.get('file_size'),
+        mime=mime or 'application/octet-stream',
+        expires_at=expires_at,
+        owner=row['username'],
+        content_hash=row.get('content_hash'),
+        download_name=download_name(row),
+    )
+
+
+class LocationIndex:
+    def __init__(self, db, max_entries=100_000, ttl=60):
+        self.db = db
+        self._cache = LRUCache(max_entries * ENTRY_SIZE, ttl=ttl)
+
+    def warm(self, limit=10_000):
+        """Preload the most recent uploads; returns how many were loaded"""
+        rows = self.db.get_recent_locations(limit)
+        # Oldest first, so the newest end up most recently used
+        for row in reversed(rows):
+            self.put(location_from_row(row))
+        return len(rows)
+
+    def cached(self, filename):
+        """Location for ``filename`` if it is in memory; never queries"""
+        return self._cache.get(filename)
+
+    def get(self, filename):
+        """Location for ``filename``, or None if no such image exists"""
+        location = self._cache.get(filename)
+        if location is None:
+            row = self.db.get_image_location(filename)
+            if row is None:
+                # Not cached: an upload in another process must show up at once
+                return None
+            location = self.put(location_from_row(row))
+        return location
+
+    def put(self, location):
+        return self._cache.put(location.filename, location, ENTRY_SIZE)
+
+    def discard(self, filename):
+        self._cache.pop(filename)
+
+    def clear(self):
+        self._cache.clear()
@@ -0,0 +1,325 @@
+"""Maintenance commands for ImageHub Pro.
+
+Run from the app directory, e.g. ``python manage.py backfill-derivatives``.
+"""
+import argparse
+import os
+import sys
+import time
+
+from database import DatabaseManager
+
+
+def backfill_derivatives(args):
+    from imaging import generate_derivatives
+
+    db = DatabaseManager()
+    after_id = 0
+    created = failed = 0
+    while True:
+        batch = db.get_images_missing_derivatives(after_id, args.batch_size)
+        if not batch:
+            break
+        for image in batch:
+            after_id = image['id']
+            output_dir, filename = os.path.split(image['file_path'])
+            stem = os.path.splitext(filename)[0]
+            try:
+                derivatives = generate_derivatives(image['file_path'], output_dir, stem)
+            except Exception as e:
+                failed += 1
+                print(f"Skipping image {image['id']} ({image['file_path']}): {e}", file=sys.stderr)
+                continue
+            db.save_derivatives(image['id'], derivatives)
+            created += len(derivatives)
+        print(f"Processed up to image {after_id}: {created} derivatives written, {failed} failed")
+
+
+def backfill_metadata(args):
+    from imaging import probe_image
+
+    db = DatabaseManager()
+    after_id = 0
+    updated = failed = 0
+    while True:
+        batch = db.get_images_missing_metadata(after_id, args.batch_size)
+        if not batch:
+            break
+        for image in batch:
+            after_id = image['id']
+            try:
+                # Already stored: record what it is, however large
+                metadata = probe_image(image['file_path'], limits=False)
+            except (OSError, ValueError) as e:
+                failed += 1
+                print(f"Skipping image {image['id']} ({image['file_path']}): {e}", file=sys.stderr)
+                continue
+            db.set_image_metadata(image['id'], metadata)
+            updated += 1
+        print(f"Processed up to image {after_id}: {updated} updated, {failed} failed")
+
+
+def backfill_hashes(args):
+    from imaging import perceptual_hash
+
+    db = DatabaseManager()
+    after_id = 0
+    updated = failed = 0
+    while True:
+        batch = db.get_images_missing_phash(after_id, args.batch_size)
+        if not batch:
+            break
+        for image in batch:
+            after_id = image['id']
+            try:
+                phash = perceptual_hash(image['file_path'])
+            except (OSError, ValueError) as e:
+                failed += 1
+                print(f"Skipping image {image['id']} ({image['file_path']}): {e}", file=sys.stderr)
+                continue
+            db.set_image_hash(image['id'], phash)
+            updated += 1
+        print(f"Processed up to image {after_id}: {updated} hashed, {failed} failed")
+
+
+def check_stats(args):
+    db = DatabaseManager()
+    mismatched = db.check_user_stats(repair=args.repair)
+    if not mismatched:
+        print("user_stats is consistent with images")
+        return
+    action = "Rebuilt" if args.repair else "Out of date"
+    print(f"{action}: {len(mismatched)} user(s): {', '.join(mismatched)}")
+    if not args.repair:
+        sys.exit(1)
+
+
+def dedupe_storage(args):
+    from storage import BlobStore, hash_file
+
+    db = DatabaseManager()
+    storage = BlobStore()
+    after_id = 0
+    migrated = reclaimed = missing = 0
+    while True:
+        batch = db.get_images_without_hash(after_id, args.batch_size)
+        if not batch:
+            break
+        for image in batch:
+            after_id = image['id']
+            source = next((p for p in (image['file_path'], image['media_path']) if os.path.isfile(p)), None)
+            if source is None:
+                missing += 1
+                print(f"Skipping image {image['id']}: no file on disk", file=sys.stderr)
+                continue
+
+            content_hash = hash_file(source)
+            with db.pool.transaction():
+                blob_path, _ = storage.adopt(source, content_hash, image['file_extension'])
+                old_paths = db.set_image_blob(image['id'], content_hash, blob_path)
+                # Old per-user and media copies go once nothing points at them
+                for path in old_paths:
+                    if os.path.exists(path) and not db.is_path_referenced(path):
+                        stat = os.stat(path)
+                        os.remove(path)
+                        if stat.st_nlink == 1:
+                            reclaimed += stat.st_size
+            migrated += 1
+        print(f"Processed up to image {after_id}: {migrated} migrated, "
+              f"{reclaimed / 1024 / 1024:.1f} MB reclaimed, {missing} missing")
+
+
+def shard_storage(args):
+    from storage import BlobStore
+
+    db = DatabaseManager()
+    storage = BlobStore()
+    after_id = 0
+    moved = missing = 0
+    while True:
+        batch = db.get_image_paths(after_id, args.batch_size)
+        if not batch:
+            break
+        after_id = batch[-1]['id']
+        paths = {path for image in batch for path in (image['file_path'], image['media_path'])}
+        for derivatives in db.get_derivatives(image['id'] for image in batch).values():
+            paths.update(d['path'] for d in derivatives)
+
+        for old_path in sorted(p for p in paths if storage.is_flat(p)):
+            if not os.path.isfile(old_path):
+                missing += 1
+                continue
+            new_path = storage.sharded_path(old_path)
+            # Readers keep finding the old file until the rows point at the new one
+            with db.pool.transaction():
+                storage.place(old_path, new_path)
+                db.relocate_path(old_path, new_path)
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+            moved += 1
+        print(f"Processed up to image {after_id}: {moved} files moved, {missing} missing")
+        time.sleep(args.pause)
+
+
+def fsck(args):
+    import socket
+    from fsck import StorageChecker
+
+    db = DatabaseManager()
+    checker = StorageChecker(db, action=args.action, min_age=args.min_age)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        totals = {'scanned': 0, 'orphans': 0, 'bytes': 0, 'young': 0, 'rows': 0, 'missing': 0}
+        files_done = rows_done = False
+        while not (files_done and rows_done):
+            # One checker at a time across the deployment
+            if not db.acquire_lease("fsck", owner, ttl=max(60, args.pause * 10)):
+                sys.exit("Another fsck is running")
+            if not files_done:
+                report = checker.check_files(args.batch_size)
+                files_done = report['done']
+                for field in ('scanned', 'orphans', 'bytes', 'young'):
+                    totals[field] += report[field]
+            if not rows_done:
+                report = checker.check_rows(args.batch_size, prune=args.prune_missing)
+                rows_done = report['done']
+                totals['rows'] += report['scanned']
+                totals['missing'] += len(report['missing'])
+                for image_id in report['missing']:
+                    print(f"Image {image_id} has no file on disk{' (removed)' if args.prune_missing else ''}",
+                          file=sys.stderr)
+            time.sleep(args.pause)
+
+        verb = {"report": "reclaimable", "quarantine": "quarantined", "delete": "reclaimed"}[args.action]
+        print(f"Checked {totals['scanned']} files and {totals['rows']} images: {totals['orphans']} orphans, "
+              f"{totals['bytes'] / 1024 / 1024:.1f} MB {verb}, {totals['young']} too recent to judge, "
+              f"{totals['missing']} images missing their file")
+        if not args.continuous:
+            db.release_lease("fsck", owner)
+            break
+        time.sleep(args.interval)
+
+
+def rotate_share_key(args):
+    from signing import KEYS_FILE, rotate_keys
+
+    if os.environ.get("SHARE_SIGNING_KEYS"):
+        sys.exit("SHARE_SIGNING_KEYS is set; rotate keys in that variable instead")
+    version = rotate_keys(retire=args.retire)
+    print(f"Key {version} is now current in {KEYS_FILE}; restart the app and media server to use it")
+
+
+def transcode(args):
+    from transcoding import Transcoder
+
+    db = DatabaseManager()
+    transcoder = Transcoder(db)
+    tag = transcoder.policy.tag
+    # Resumes where an interrupted run stopped, as long as the policy is unchanged
+    cursor = db.get_cursor("transcode")
+    after_id = int(cursor.partition(":")[2]) if cursor and cursor.startswith(f"{tag}:") else 0
+    processed = saved = 0
+    while True:
+        batch = db.get_images_to_transcode(tag, after_id, args.batch_size)
+        if not batch:
+            break
+        for image in batch:
+            after_id = image['id']
+            try:
+                saved += transcoder.apply(image)
+            except Exception as e:
+                print(f"Skipping image {image['id']} ({image['file_path']}): {e}", file=sys.stderr)
+            processed += 1
+        db.set_cursor("transcode", f"{tag}:{after_id}")
+        print(f"Processed up to image {after_id}: {processed} checked, {saved / 1024 / 1024:.1f} MB saved")
+        time.sleep(args.pause)
+    db.set_cursor("transcode", None)
+    count, total = db.get_transcode_savings()
+    print(f"Policy {tag} applied. {count} images re-encoded in total, saving {total / 1024 / 1024:.1f} MB")
+
+
+def import_archive(args):
+    from image_manager import ImageManager
+    from importer import import_archive as run_import
+
+    db = DatabaseManager()
+    if not db.user_exists(args.username):
+        sys.exit(f"No such user: {args.username}")
+
+    def report(record):
+        print(f"{record['position']} entries read: {record['imported']} imported, {record['failed']} failed")
+
+    def report_error(name, error):
+        print(f"Skipping {name}: {error}", file=sys.stderr)
+
+    record = run_import(ImageManager(db), args.username, args.archive,
+                        auto_delete_hours=args.auto_delete_hours, batch_size=args.batch_size,
+                        progress_callback=report, error_callback=report_error)
+    print(f"Import of {record['archive_name']} complete: {record['imported']} imported, {record['failed']} failed")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ImageHub Pro maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill = commands.add_parser("backfill-derivatives", help="Generate thumbnails/previews for stored images")
+    backfill.add_argument("--batch-size", type=int, default=100)
+    backfill.set_defaults(handler=backfill_derivatives)
+
+    metadata = commands.add_parser("backfill-metadata", help="Record dimensions/format for stored images")
+    metadata.add_argument("--batch-size", type=int, default=200)
+    metadata.set_defaults(handler=backfill_metadata)
+
+    hashes = commands.add_parser("backfill-hashes", help="Compute perceptual hashes for stored images")
+    hashes.add_argument("--batch-size", type=int, default=200)
+    hashes.set_defaults(handler=backfill_hashes)
+
+    stats = commands.add_parser("check-stats", help="Verify the per-user totals in user_stats")
+    stats.add_argument("--repair", action="store_true", help="Rebuild user_stats from images if it differs")
+    stats.set_defaults(handler=check_stats)
+
+    dedupe = commands.add_parser("dedupe-storage", help="Move stored files into the content-addressed blob store")
+    dedupe.add_argument("--batch-size", type=int, default=100)
+    dedupe.set_defaults(handler=dedupe_storage)
+
+    shard = commands.add_parser("shard-storage", help="Move blobs from the flat layout into hashed subdirectories")
+    shard.add_argument("--batch-size", type=int, default=200)
+    shard.add_argument("--pause", type=float, default=0.1, help="Seconds to sleep between batches")
+    shard.set_defaults(handler=shard_storage)
+
+    recode = commands.add_parser("transcode", help="Apply the transcoding policy to stored images")
+    recode.add_argument("--batch-size", type=int, default=50)
+    recode.add_argument("--pause", type=float, default=0.1, help="Seconds to sleep between batches")
+    recode.set_defaults(handler=transcode)
+
+    archive = commands.add_parser("import-archive", help="Import every image in a ZIP/TAR archive for a user")
+    archive.add_argument("username")
+    archive.add_argument("archive", help="Path to a .zip, .tar, .tar.gz, ... file")
+    archive.add_argument("--auto-delete-hours", type=int, default=0)
+    archive.add_argument("--batch-size", type=int, default=50)
+    archive.set_defaults(handler=import_archive)
+
+    check = commands.add_parser("fsck", help="Find orphaned files and images whose files are missing")
+    check.add_argument("--action", choices=("report", "quarantine", "delete"), default="report",
+                       help="What to do with orphaned files (quarantine moves them to user_data/quarantine)")
+    check.add_argument("--min-age", type=float, default=3600, help="Ignore files modified within this many seconds")
+    check.add_argument("--prune-missing", action="store_true", help="Delete images whose file is gone")
+    check.add_argument("--batch-size", type=int, default=500)
+    check.add_argument("--pause", type=float, default=0.1, help="Seconds to sleep between batches")
+    check.add_argument("--continuous", action="store_true", help="Keep running passes")
+    check.add_argument("--interval", type=float, default=3600, help="Seconds between passes with --continuous")
+    check.set_defaults(handler=fsck)
+
+    rotate = commands.add_parser("rotate-share-key", help="Start signing share links with a new key")
+    rotate.add_argument("--retire", type=int, nargs="*", default=[], metavar="VERSION",
+                        help="Old key versions to drop; links signed with them stop working")
+    rotate.set_defaults(handler=rotate_share_key)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
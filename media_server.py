@@ -0,0 +1,348 @@
+"""Standalone ASGI server for shared images and downloads.
+
+Serves ``/media/<filename>`` (the shareable URLs), ``/download/<filename>``
+and ``/export/<id>`` (streaming ZIP exports) straight from the blob store,
+outside the Streamlit process. Filenames resolve through an in-memory
+LocationIndex, so hot links are served without touching SQLite, and signed
+links (see signing.py) that are forged or expired are refused before any
+lookup. Unsigned links are refused too, so a link's expiry can't be dropped
+by stripping its query string; ``REQUIRE_SIGNED_LINKS=0`` turns that off.
+Responses carry strong ETags and Cache-Control, honour conditional and
+Range requests, and use the ASGI zero-copy/pathsend extensions when the
+server offers them, falling back to chunked reads otherwise. Run it next to
+the app with e.g.
+``uvicorn media_server:app --port 8502 --workers 4``.
+"""
+import asyncio
+import os
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs, quote, unquote
+
+from database import DatabaseManager
+from exporter import export_filename, stream_export
+from locations import LocationIndex, content_version
+from signing import InvalidSignature, LinkExpired, LinkSigner
+from views import ViewCounter
+
+CHUNK_SIZE = 256 * 1024
+# URLs carrying the current content version (``v=``) name fixed bytes, so
+# caches may keep them; re-encoding moves the image to a new version
+MAX_AGE = 365 * 24 * 3600
+# Without it the bytes behind a filename can still be replaced by
+# transcoding, so caches revalidate (cheaply, by ETag) after this long
+REVALIDATE_AGE = 300
+REQUIRE_SIGNED_LINKS = os.environ.get("REQUIRE_SIGNED_LINKS", "1") != "0"
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """Return the (start, end) byte span of a single-range header, or None.
+
+    ``end`` is inclusive. Multi-range requests are served as the full file.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if not start:
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def content_disposition(original_name):
+    fallback = original_name.encode("ascii", "replace").decode().replace('"', "")
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(original_name)}"
+
+
+def make_etag(content_hash, stat):
+    if content_hash:
+        return f'"{content_hash}"'
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def etag_matches(header, etag, weak=True):
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in header.split(",")]
+    if weak:
+        tags = [tag.removeprefix("W/") for tag in tags]
+    return etag in tags
+
+
+def not_modified_since(header, mtime):
+    if header is None:
+        return False
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def seconds_until_expiry(expires_at, now=None):
+    """Seconds left before the image expires, or None if it never does"""
+    if not expires_at:
+        return None
+    return (expires_at - (now or datetime.now())).total_seconds()
+
+
+async def send_response(send, status, headers=(), body=b""):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode(), str(v).encode()) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_file(scope, send, path, status, headers, start, length, head_only=False):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode(), str(v).encode()) for k, v in headers],
+    })
+    if head_only or length == 0:
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    extensions = scope.get("extensions") or {}
+    if "http.response.pathsend" in extensions and start == 0 and length == os.path.getsize(path):
+        await send({"type": "http.response.pathsend", "path": os.path.abspath(path)})
+        return
+
+    with open(path, "rb") as f:
+        if "http.response.zerocopysend" in extensions:
+            # The server sendfile()s straight from our descriptor
+            await send({
+                "type": "http.response.zerocopysend",
+                "file": f.fileno(),
+                "offset": start,
+                "count": length,
+            })
+            return
+
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+    if remaining > 0:
+        # File shrank underneath us; end the response rather than hang
+        await send({"type": "http.response.body", "body": b""})
+
+
+class MediaServer:
+    def __init__(self, db=None, locations=None, signer=None):
+        self._db = db
+        self._locations = locations
+        self._signer = signer
+        self.view_counter = None
+
+    @property
+    def db(self):
+        # Created lazily so importing this module never touches the database
+        if self._db is None:
+            self._db = DatabaseManager()
+        return self._db
+
+    @property
+    def locations(self):
+        if self._locations is None:
+            self._locations = LocationIndex(self.db)
+        return self._locations
+
+    @property
+    def signer(self):
+        if self._signer is None:
+            self._signer = LinkSigner()
+        return self._signer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        if scope["method"] not in ("GET", "HEAD"):
+            await send_response(send, 405, [("allow", "GET, HEAD")])
+            return
+
+        path = unquote(scope["path"])
+        if path.startswith("/export/"):
+            await self.serve_export(scope, send, path[len("/export/"):])
+            return
+        for prefix, attachment in (("/media/", False), ("/download/", True)):
+            if path.startswith(prefix):
+                await self.serve(scope, send, path[len(prefix):], attachment)
+                return
+        await send_response(send, 404)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await asyncio.to_thread(self.locations.warm)
+                self.view_counter = ViewCounter(self.db)
+                self.view_counter.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.view_counter is not None:
+                    await asyncio.to_thread(self.view_counter.stop)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def lookup(self, filename):
+        location = self.locations.cached(filename)
+        if location is None:
+            # Misses fall through to one point query off the event loop
+            location = await asyncio.to_thread(self.locations.get, filename)
+        return location
+
+    def verify_link(self, scope, name, required=REQUIRE_SIGNED_LINKS):
+        """Check a signed link; returns (error status or None, link expiry or None)"""
+        query = parse_qs(scope.get("query_string", b"").decode())
+        if "s" not in query and not required:
+            return None, None
+        expires, version, signature = (query.get(field, [None])[0] for field in ("e", "k", "s"))
+        try:
+            self.signer.verify(name, expires, version, signature)
+        except InvalidSignature:
+            return 403, None
+        except LinkExpired:
+            return 410, None
+        return None, datetime.fromtimestamp(int(expires)) if int(expires) else None
+
+    async def serve_export(self, scope, send, export_id):
+        status, _ = self.verify_link(scope, f"export/{export_id}", required=True)
+        if status:
+            await send_response(send, status, [("cache-control", "no-store")])
+            return
+        export = await asyncio.to_thread(self.db.get_export, export_id)
+        if export is None:
+            await send_response(send, 404)
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"application/zip"),
+                (b"content-disposition", f'attachment; filename="{export_filename()}"'.encode()),
+                (b"cache-control", b"no-store"),
+            ],
+        })
+        if scope["method"] != "HEAD":
+            # The archive is built a chunk at a time on a worker thread, so a
+            # large export holds neither memory nor the event loop
+            chunks = stream_export(self.db, export["username"], export["filenames"])
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def serve(self, scope, send, filename, attachment):
+        if "/" in filename or not filename:
+            await send_response(send, 404)
+            return
+
+        # Signed links are checked with CPU work alone, before any lookup
+        status, link_expires = self.verify_link(scope, filename)
+        if status:
+            await send_response(send, status, [("cache-control", "no-store")])
+            return
+
+        # Expiry is checked on the resolved location, never by scanning
+        location = await self.lookup(filename)
+        if location is None:
+            await send_response(send, 404)
+            return
+        expires_at = min(filter(None, (location.expires_at, link_expires)), default=None)
+        remaining = seconds_until_expiry(expires_at)
+        if remaining is not None and remaining <= 0:
+            await send_response(send, 410, [("cache-control", "no-store")])
+            return
+        try:
+            stat = os.stat(location.path)
+        except OSError:
+            await send_response(send, 404)
+            return
+
+        if self.view_counter is not None:
+            self.view_counter.increment(filename)
+
+        headers = dict((k.decode().lower(), v.decode()) for k, v in scope["headers"])
+        etag = make_etag(location.content_hash, stat)
+        version = parse_qs(scope.get("query_string", b"").decode()).get("v", [None])[0]
+        current = version is not None and version == content_version(location.content_hash)
+        max_age = MAX_AGE if current else REVALIDATE_AGE
+        # Never let a cache outlive the image's auto-delete time or the link
+        if remaining is None:
+            cache_control = f"public, max-age={max_age}" + (", immutable" if current else "")
+        else:
+            cache_control = f"public, max-age={int(min(remaining, max_age))}"
+        cache_headers = [
+            ("etag", etag),
+            ("last-modified", formatdate(stat.st_mtime, usegmt=True)),
+            ("cache-control", cache_control),
+        ]
+
+        # If-None-Match wins over If-Modified-Since (RFC 9110 13.2.2)
+        if "if-none-match" in headers:
+            not_modified = etag_matches(headers["if-none-match"], etag)
+        else:
+            not_modified = not_modified_since(headers.get("if-modified-since"), stat.st_mtime)
+        if not_modified:
+            await send_response(send, 304, cache_headers)
+            return
+
+        response_headers = cache_headers + [
+            ("content-type", location.mime),
+            ("accept-ranges", "bytes"),
+        ]
+        if attachment:
+            response_headers.append(("content-disposition", content_disposition(location.download_name)))
+
+        size = stat.st_size
+        range_header = headers.get("range")
+        if "if-range" in headers and not etag_matches(headers["if-range"], etag, weak=False):
+            range_header = None
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            await send_response(send, 416, [("content-range", f"bytes */{size}")])
+            return
+
+        status, start, length = 200, 0, size
+        if byte_range:
+            start, end = byte_range
+            status, length = 206, end - start + 1
+            response_headers.append(("content-range", f"bytes {start}-{end}/{size}"))
+        response_headers.append(("content-length", length))
+
+        await send_file(scope, send, location.path, status, response_headers, start, length,
+                        head_only=scope["method"] == "HEAD")
+
+
+app = MediaServer()
@@ -0,0 +1,141 @@
+"""HMAC-signed share links.
+
+A signed link carries its own validity: ``?e=<expiry>&k=<key version>&s=<sig>``
+where ``sig`` is an HMAC-SHA256 over the filename, expiry and key version.
+The media server can therefore turn away forged or expired links with a
+hash computation and no database lookup.
+
+Keys come from ``SHARE_SIGNING_KEYS`` (``"version:secret,..."``, current key
+first) or, failing that, from ``user_data/share_keys.json``, which is created
+with a random key on first use. Rotating adds a new current key and keeps
+the old ones for verification, so links already handed out stay valid
+until they expire; retire an old version only once its links have lapsed.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+KEYS_FILE = "user_data/share_keys.json"
+SIGNATURE_BYTES = 16
+# Per-link expiries are rounded up to a step, so a card's URL (and the HTML
+# cached around it) stays the same across reruns. The step is at most
+# EXPIRY_GRANULARITY and at most 1/EXPIRY_STEPS of the ttl, so a "1 hour"
+# link lasts no more than 65 minutes
+EXPIRY_GRANULARITY = 3600
+EXPIRY_STEPS = 12
+
+
+class InvalidSignature(Exception):
+    pass
+
+
+class LinkExpired(Exception):
+    pass
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def load_keys(path=KEYS_FILE):
+    """``{version: secret bytes}`` plus the current version"""
+    configured = os.environ.get("SHARE_SIGNING_KEYS")
+    if configured:
+        keys = {}
+        for entry in configured.split(","):
+            version, _, secret = entry.strip().partition(":")
+            keys[int(version)] = secret.encode()
+        return keys, int(configured.split(",")[0].partition(":")[0])
+
+    if not os.path.exists(path):
+        _create_keys(path)
+    # Read back even after creating it: another process may have won the race
+    with open(path) as f:
+        data = json.load(f)
+    keys = {int(version): bytes.fromhex(secret) for version, secret in data["keys"].items()}
+    return keys, data["current"]
+
+
+def _create_keys(path):
+    """Write a first key file unless one exists; safe for racing processes"""
+    temp_path = _write_temp(path, {"current": 1, "keys": {"1": secrets.token_hex(32)}})
+    try:
+        # link() fails if the file exists, and readers never see it half written
+        os.link(temp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_path)
+
+
+def _write_temp(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as f:
+        json.dump(data, f, indent=2)
+    return temp_path
+
+
+def rotate_keys(path=KEYS_FILE, retire=()):
+    """Add a new current key to the key file; returns its version"""
+    data = {"current": 0, "keys": {}}
+    if os.path.exists(path):
+        with open(path) as f:
+            data = json.load(f)
+    version = max((int(v) for v in data["keys"]), default=0) + 1
+    data["keys"][str(version)] = secrets.token_hex(32)
+    data["current"] = version
+    for old in retire:
+        if int(old) != version:
+            data["keys"].pop(str(old), None)
+
+    os.replace(_write_temp(path, data), path)
+    return version
+
+
+class LinkSigner:
+    def __init__(self, keys=None, current=None):
+        if keys is None:
+            keys, current = load_keys()
+        self.keys = keys
+        self.current = current
+
+    def _signature(self, key, filename, expires, version):
+        message = f"{filename}\n{expires}\n{version}".encode()
+        return _b64(hmac.new(key, message, hashlib.sha256).digest()[:SIGNATURE_BYTES])
+
+    def sign(self, filename, expires=None):
+        """Query string for ``filename``; ``expires`` is a unix time or None for never"""
+        expires = int(expires) if expires else 0
+        signature = self._signature(self.keys[self.current], filename, expires, self.current)
+        return f"e={expires}&k={self.current}&s={signature}"
+
+    def link_expiry(self, image_expires_at=None, ttl=None, now=None):
+        """Unix expiry for a new link: the image's own expiry or ``ttl``, whichever is sooner"""
+        candidates = []
+        if image_expires_at:
+            candidates.append(image_expires_at.timestamp())
+        if ttl:
+            deadline = (now or time.time()) + ttl
+            step = max(1, min(EXPIRY_GRANULARITY, ttl // EXPIRY_STEPS))
+            candidates.append(-(-deadline // step) * step)
+        return min(candidates) if candidates else None
+
+    def verify(self, filename, expires, version, signature, now=None):
+        """Raise InvalidSignature or LinkExpired unless the link is good"""
+        try:
+            expires, version = int(expires), int(version)
+        except (TypeError, ValueError):
+            raise InvalidSignature("malformed link")
+        key = self.keys.get(version)
+        if key is None or signature is None:
+            raise InvalidSignature("unknown key version")
+        expected = self._signature(key, filename, expires, version)
+        if not hmac.compare_digest(expected, signature):
+            raise InvalidSignature("bad signature")
+        if expires and expires <= (now or time.time()):
+            raise LinkExpired()
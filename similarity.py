@@ -0,0 +1,57 @@
+"""Near-duplicate lookup by perceptual hash.
+
+Every image gets a 64-bit difference hash (imaging.perceptual_hash):
+resized copies, re-encodes and format changes of one photo land within a
+few bits of each other, where byte-level dedupe sees different files.
+
+Finding all hashes within Hamming distance ``r`` of a query uses a
+multi-index hash. The 64 bits are split into HASH_CHUNKS 16-bit chunks,
+and by pigeonhole any hash within ``r`` bits matches the query on at
+least one chunk to within ``r // HASH_CHUNKS`` bits. A lookup therefore
+probes a few hundred (chunk, value) keys of ``image_hash_chunks`` and
+checks only the candidates found there, never the whole library. Rows
+are written by the image's derivatives job (see worker.py) and removed
+with the image, so the index never needs a rebuild; ``manage.py
+backfill-hashes`` covers images stored before it.
+"""
+from itertools import combinations
+
+HASH_BITS = 64
+HASH_CHUNKS = 4
+CHUNK_BITS = HASH_BITS // HASH_CHUNKS
+# The same photo resized or re-saved; used for upload warnings
+DUPLICATE_DISTANCE = 4
+# Visibly the same scene; used for "find similar"
+SIMILAR_DISTANCE = 10
+
+
+def to_signed(value):
+    """Store a 64-bit hash in an SQLite INTEGER"""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value & ((1 << HASH_BITS) - 1)
+
+
+def hash_chunks(value):
+    """The HASH_CHUNKS chunk values of a hash, lowest bits first"""
+    value = to_unsigned(value)
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (chunk * CHUNK_BITS)) & mask for chunk in range(HASH_CHUNKS)]
+
+
+def chunk_probes(value, radius):
+    """Every chunk value within ``radius`` bits of ``value``"""
+    probes = [value]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            probes.append(flipped)
+    return probes
+
+
+def hamming(a, b):
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import uuid
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Extensions that name the same format are stored under one spelling
+EXTENSION_ALIASES = {'jpeg': 'jpg'}
+
+
+def new_hasher():
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_file(path):
+    """Streaming content hash of a file on disk"""
+    hasher = new_hasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class BlobStore:
+    """Content-addressed file store: each distinct upload is kept once.
+
+    Blobs are named after the hash of their bytes and fanned out over two
+    levels of directories (``ab/cd/abcd....jpg``) so no directory grows
+    past a few thousand entries. Images reference them through
+    ``images.file_path``/``media_path``; DatabaseManager frees a blob when
+    the last row pointing at it goes away.
+    """
+
+    def __init__(self, root="static/media"):
+        self.root = root
+        self.tmp_dir = os.path.join(root, ".tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def shard_dir(self, content_hash):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4])
+
+    def path_for(self, content_hash, extension):
+        extension = EXTENSION_ALIASES.get(extension, extension)
+        return os.path.join(self.shard_dir(content_hash), f"{content_hash}.{extension}")
+
+    def sharded_path(self, path):
+        """Where a file from the old flat layout belongs in the sharded one"""
+        name = os.path.basename(path)
+        return os.path.join(self.shard_dir(name), name)
+
+    def is_flat(self, path):
+        return os.path.dirname(os.path.normpath(path)) == os.path.normpath(self.root)
+
+    def stage(self, fileobj):
+        """Copy ``fileobj`` to a temp file while hashing it.
+
+        Returns ``(content_hash, temp_path, size)``; hand the temp file to
+        :meth:`commit` or :meth:`discard`.
+        """
+        if hasattr(fileobj, 'seek'):
+            fileobj.seek(0)
+        hasher = new_hasher()
+        size = 0
+        temp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as out:
+                for chunk in iter(lambda: fileobj.read(HASH_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            self.discard(temp_path)
+            raise
+        return hasher.hexdigest(), temp_path, size
+
+    def commit(self, temp_path, content_hash, extension):
+        """Move a staged file into place; returns ``(path, created)``.
+
+        Call this inside the write transaction that inserts the referencing
+        row so a concurrent delete cannot free the blob in between.
+        """
+        path = self.path_for(content_hash, extension)
+        if os.path.exists(path):
+            self.discard(temp_path)
+            return path, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return path, True
+
+    def adopt(self, source_path, content_hash, extension):
+        """Bring an existing file into the store (used by the dedupe migration)"""
+        path = self.path_for(content_hash, extension)
+        if os.path.exists(path):
+            return path, False
+        return self.place(source_path, path)
+
+    def place(self, source_path, path):
+        """Link or copy ``source_path`` to ``path``, leaving the source intact"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Link or copy rather than move: the old path must stay valid until
+        # the row is updated
+        try:
+            os.link(source_path, path)
+            return path, True
+        except FileExistsError:
+            return path, False
+        except OSError:
+            pass
+        temp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        with open(source_path, 'rb') as src, open(temp_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+                dst.write(chunk)
+        os.replace(temp_path, path)
+        return path, True
+
+    def discard(self, temp_path):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
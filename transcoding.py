@@ -0,0 +1,267 @@
+"""Re-encoding stored images according to a per-format policy.
+
+A policy maps an image format (as Pillow names it: ``PNG``, ``BMP``,
+``JPEG``...) to a Rule: convert to another format, optimize losslessly,
+strip metadata, cap the longest edge, and/or keep a WebP/AVIF rendition
+next to the stored file. Formats without a rule are stored as uploaded.
+
+Uploads whose format has a rule get a ``transcode`` job (see worker.py)
+instead of a plain derivatives job, so the upload itself stays fast and
+thumbnails are cut from the re-encoded file. ``manage.py transcode``
+applies the policy to images stored before it existed or before it last
+changed. The bytes saved are recorded on each image (``original_size``,
+``original_format``) and the policy version it was processed under in
+``transcode_policy``.
+
+The policy comes from ``TRANSCODE_POLICY`` (a path to a JSON file) or
+``user_data/transcode_policy.json``, e.g.
+``{"BMP": {"convert_to": "PNG"}, "PNG": {"optimize": true, "rendition": "WEBP"}}``;
+without either, DEFAULT_RULES apply.
+"""
+import hashlib
+import json
+import logging
+import os
+import uuid
+from collections import namedtuple
+from functools import lru_cache
+
+from PIL import Image, ImageOps
+
+from imaging import JPEG_QUALITY, WEBP_QUALITY, ImageTooLarge, has_alpha, open_bounded
+from storage import BlobStore, hash_file
+
+logger = logging.getLogger(__name__)
+
+POLICY_FILE = "user_data/transcode_policy.json"
+# Old files stay on disk this long after an image moves to its re-encoded
+# copy, so serving processes with a cached location never hit a missing file
+RELEASE_DELAY = 300
+
+Rule = namedtuple(
+    'Rule', 'convert_to optimize strip_metadata max_dimension rendition min_size min_savings',
+    defaults=(None, False, False, None, None, 0, 0.05),
+)
+
+DEFAULT_RULES = {
+    # Uncompressed bitmaps: always worth turning into PNG
+    'BMP': Rule(convert_to='PNG', optimize=True, strip_metadata=True),
+    # Screenshots and exports are often saved with fast, poor deflate settings
+    'PNG': Rule(optimize=True, strip_metadata=True, min_size=256 * 1024),
+    # Large GIFs shrink a lot as animated WebP; opt in with
+    # {"GIF": {"convert_to": "WEBP", "min_size": 1048576}}
+}
+FORMAT_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif', 'BMP': 'bmp', 'WEBP': 'webp', 'AVIF': 'avif'}
+LOSSLESS_FORMATS = {'PNG', 'BMP', 'GIF'}
+# Formats an animation can be converted to without losing its frames
+ANIMATED_FORMATS = {'GIF', 'WEBP'}
+
+
+class TranscodePolicy:
+    def __init__(self, rules=None):
+        self.rules = dict(DEFAULT_RULES if rules is None else rules)
+        # Identifies this policy, so a changed policy re-processes the library
+        encoded = json.dumps({fmt: rule._asdict() for fmt, rule in sorted(self.rules.items())}, sort_keys=True)
+        self.tag = hashlib.sha256(encoded.encode()).hexdigest()[:12]
+
+    def rule_for(self, image_format):
+        return self.rules.get(image_format)
+
+
+def load_policy(path=None):
+    path = path or os.environ.get("TRANSCODE_POLICY") or POLICY_FILE
+    if not os.path.exists(path):
+        return TranscodePolicy()
+    with open(path) as f:
+        data = json.load(f)
+    return TranscodePolicy({fmt.upper(): Rule(**options) for fmt, options in data.items()})
+
+
+@lru_cache(maxsize=1)
+def get_policy():
+    """The configured policy, loaded once per process"""
+    return load_policy()
+
+
+def can_encode(pil_format):
+    Image.init()
+    return pil_format in Image.SAVE
+
+
+def _save_options(pil_format, image, source_format, rule):
+    if pil_format == 'PNG':
+        return {'optimize': rule.optimize}
+    if pil_format == 'JPEG':
+        # Reusing the source's quantization tables keeps the re-encode visually lossless
+        keep = source_format == 'JPEG' and image.format == 'JPEG'
+        return {'quality': 'keep' if keep else JPEG_QUALITY, 'optimize': rule.optimize, 'progressive': True}
+    if pil_format in ('WEBP', 'AVIF'):
+        if source_format in LOSSLESS_FORMATS and pil_format == 'WEBP':
+            return {'lossless': True, 'method': 6 if rule.optimize else 4}
+        return {'quality': WEBP_QUALITY}
+    return {}
+
+
+def _convert_for(image, pil_format):
+    if pil_format in ('WEBP', 'AVIF') or (pil_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK')):
+        mode = 'RGBA' if has_alpha(image) and pil_format != 'JPEG' else 'RGB'
+        return image if image.mode == mode else image.convert(mode)
+    if pil_format == 'PNG' and image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16'):
+        return image.convert('RGBA' if has_alpha(image) else 'RGB')
+    return image
+
+
+def _write(image, pil_format, tmp_dir, options):
+    path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    try:
+        image.save(path, pil_format, **options)
+    except BaseException:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    return {
+        'path': path,
+        'format': pil_format,
+        'extension': FORMAT_EXTENSIONS[pil_format],
+        'size': os.path.getsize(path),
+        'width': image.width,
+        'height': image.height,
+        'mode': image.mode,
+    }
+
+
+def _encode_animation(image, rule, tmp_dir):
+    """Convert an animation frame by frame; never resized or transposed"""
+    target = rule.convert_to or image.format
+    if target not in ANIMATED_FORMATS or not can_encode(target):
+        return None
+    options = {**_save_options(target, image, image.format, rule), 'save_all': True}
+    if target == 'GIF':
+        options['optimize'] = rule.optimize
+    stored = _write(image, target, tmp_dir, options)
+    stored.update(resized=False, orientation=None, mode='RGBA' if target == 'WEBP' else image.mode)
+    return stored
+
+
+def encode(source_path, rule, tmp_dir):
+    """Re-encode ``source_path`` under ``rule`` into temp files.
+
+    Returns ``(stored, rendition)``: the candidate replacement for the file
+    and the extra rendition, either of which may be None. The caller owns
+    (and must remove or move) the temp files. Animations only go to
+    animated formats (e.g. GIF to animated WebP) and get no rendition.
+    """
+    with open_bounded(source_path) as image:
+        if getattr(image, 'is_animated', False):
+            return _encode_animation(image, rule, tmp_dir), None
+        source_format = image.format
+        resized = False
+        info = dict(image.info)
+        if rule.strip_metadata or rule.max_dimension:
+            # Bake the EXIF orientation into the pixels before dropping or resizing
+            image = ImageOps.exif_transpose(image)
+        if rule.max_dimension and max(image.size) > rule.max_dimension:
+            image = image.copy()
+            image.thumbnail((rule.max_dimension, rule.max_dimension), Image.LANCZOS)
+            resized = True
+
+        target = rule.convert_to or source_format
+        stored = None
+        if can_encode(target):
+            options = _save_options(target, image, source_format, rule)
+            if not rule.strip_metadata:
+                options.update({key: info[key] for key in ('exif', 'icc_profile') if info.get(key)})
+            elif info.get('icc_profile'):
+                # Not metadata: without it colours shift
+                options['icc_profile'] = info['icc_profile']
+            stored = _write(_convert_for(image, target), target, tmp_dir, options)
+            stored['resized'] = resized
+            stored['orientation'] = 1 if rule.strip_metadata or rule.max_dimension else None
+
+        rendition = None
+        if rule.rendition and can_encode(rule.rendition):
+            options = _save_options(rule.rendition, image, source_format, rule)
+            rendition = _write(_convert_for(image, rule.rendition), rule.rendition, tmp_dir, options)
+    return stored, rendition
+
+
+class Transcoder:
+    def __init__(self, db, storage=None, policy=None):
+        self.db = db
+        self.storage = storage or BlobStore()
+        self.policy = policy or get_policy()
+
+    def apply(self, image):
+        """Apply the policy to one image row; returns the bytes saved.
+
+        ``image`` needs id, file_path, file_size and image_format. The row
+        is only switched to the new file if it is at least ``min_savings``
+        smaller (or had to be resized); the old file is released after
+        RELEASE_DELAY by a ``release-files`` job.
+        """
+        rule = self.policy.rule_for(image['image_format'])
+        if rule is None or image['file_size'] < rule.min_size:
+            self.db.mark_transcoded(image['id'], self.policy.tag)
+            return 0
+        try:
+            stored, rendition = encode(image['file_path'], rule, self.storage.tmp_dir)
+        except (ImageTooLarge, OSError) as e:
+            logger.warning("Not transcoding image %s: %s", image['id'], e)
+            self.db.mark_transcoded(image['id'], self.policy.tag)
+            return 0
+
+        saved = 0
+        if stored and (stored['resized'] or stored['size'] <= image['file_size'] * (1 - rule.min_savings)):
+            saved = self._replace(image, stored)
+        elif stored:
+            self.storage.discard(stored['path'])
+        if rendition:
+            self._add_rendition(image['id'], rendition)
+        if not saved:
+            self.db.mark_transcoded(image['id'], self.policy.tag)
+        return saved
+
+    def _replace(self, image, stored):
+        content_hash = hash_file(stored['path'])
+        with self.db.pool.transaction():
+            blob_path, _ = self.storage.commit(stored['path'], content_hash, stored['extension'])
+            released = self.db.replace_image_blob(image['id'], image['file_path'], {
+                'content_hash': content_hash,
+                'file_path': blob_path,
+                'file_size': stored['size'],
+                'file_extension': stored['extension'],
+                'image_format': stored['format'],
+                'width': stored['width'],
+                'height': stored['height'],
+                'color_mode': stored['mode'],
+                'orientation': stored['orientation'],
+            }, self.policy.tag)
+            if released is None:
+                # Deleted or changed meanwhile; a new blob no row uses is fsck's to collect
+                return 0
+            if released:
+                self.db.enqueue_job('release-files', payload={'paths': sorted(released)}, delay=RELEASE_DELAY)
+        image['file_path'] = blob_path
+        image['content_hash'] = content_hash
+        return image['file_size'] - stored['size']
+
+    def _add_rendition(self, image_id, rendition):
+        with self.db.pool.transaction():
+            source = self.db.get_image_source(image_id)
+            if source is None or rendition['size'] >= source['file_size']:
+                # Only worth keeping if it is smaller than what we serve already
+                self.storage.discard(rendition['path'])
+                return
+            stem = source['content_hash'] or os.path.splitext(os.path.basename(source['file_path']))[0]
+            path = os.path.join(os.path.dirname(source['file_path']), f"{stem}_full.{rendition['extension']}")
+            os.replace(rendition['path'], path)
+            self.db.save_derivatives(image_id, [{
+                'kind': 'full',
+                'format': rendition['extension'],
+                'path': path,
+                'width': rendition['width'],
+                'height': rendition['height'],
+                'file_size': rendition['size'],
+            }])
@@ -0,0 +1,73 @@
+"""Buffered view counting.
+
+Serving a shared image must not wait on SQLite's write lock. ViewCounter
+records hits in a deque (``append`` is atomic, so callers never take a
+lock) and a background thread folds them into one batched UPDATE every
+``interval`` seconds or every ``max_events`` hits, whichever comes first.
+Counts in ``images.views`` therefore lag by at most a few seconds.
+"""
+import atexit
+import logging
+import threading
+from collections import Counter, deque
+
+from database import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter(threading.Thread):
+    def __init__(self, db=None, interval=5.0, max_events=1000):
+        super().__init__(name="view-counter", daemon=True)
+        self.db = db or DatabaseManager()
+        self.interval = interval
+        self.max_events = max_events
+        self._events = deque()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def increment(self, filename):
+        self._events.append(filename)
+        if len(self._events) >= self.max_events:
+            self._wakeup.set()
+
+    def start(self):
+        super().start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        """Stop the thread and write out whatever is still buffered"""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+        self.flush()
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Apply buffered hits in one transaction; returns how many were written"""
+        counts = Counter()
+        events = self._events
+        try:
+            while True:
+                counts[events.popleft()] += 1
+        except IndexError:
+            pass
+        if not counts:
+            return 0
+        try:
+            self.db.add_views(counts)
+        except Exception:
+            # Put them back for the next attempt rather than lose them
+            logger.exception("Flushing %d view counts failed", len(counts))
+            for filename, count in counts.items():
+                events.extend([filename] * count)
+            return 0
+        return sum(counts.values())
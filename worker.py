@@ -0,0 +1,190 @@
+"""Background job processing.
+
+Uploads only stage, validate and commit; anything heavy (derivative
+generation, perceptual hashing, re-encoding under the transcode policy)
+is queued in the ``jobs`` table in the same transaction as the image row.
+JobWorker threads lease jobs from it, retry failures with exponential
+backoff and give up after ``max_attempts``. A job whose worker dies is
+picked up again once its lease runs out.
+
+Run ``python worker.py --processes 4`` for dedicated worker processes;
+throughput grows with the process count. Each app process also runs one
+JobWorker thread so a single-process deployment still gets thumbnails;
+set ``IN_PROCESS_JOB_WORKER=0`` to turn that off when dedicated workers run.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import threading
+import traceback
+import uuid
+
+from database import DatabaseManager
+from imaging import ImageTooLarge, generate_derivatives, perceptual_hash
+from transcoding import Transcoder
+
+logger = logging.getLogger(__name__)
+
+IN_PROCESS_WORKER = os.environ.get("IN_PROCESS_JOB_WORKER", "1") == "1"
+LEASE_TTL = 300.0
+RETRY_BASE = 5.0
+RETRY_MAX = 3600.0
+
+HANDLERS = {}
+
+
+def handler(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+@handler("derivatives")
+def make_derivatives(db, job):
+    image = db.get_image_source(job['image_id'])
+    if image is None:
+        return  # deleted while queued
+    if image['phash'] is None:
+        record_hash(db, image)
+    derivatives = db.get_derivatives_by_hash(image['content_hash']) if image['content_hash'] else []
+    # A transcode rendition on its own doesn't stand in for thumbnails and
+    # posters; those are all reused
+    derivatives = [d for d in derivatives if d['kind'] != 'full']
+    if not derivatives:
+        output_dir, filename = os.path.split(image['file_path'])
+        stem = image['content_hash'] or os.path.splitext(filename)[0]
+        try:
+            derivatives = generate_derivatives(image['file_path'], output_dir, stem)
+        except ImageTooLarge as e:
+            # Retrying won't shrink it; the gallery shows a placeholder instead
+            logger.warning("No derivatives for image %s: %s", image['id'], e)
+            return
+    with db.pool.transaction():
+        # Skip the rows if the image went away while we were resizing;
+        # fsck collects the files
+        if db.get_image_source(image['id']) is not None:
+            db.save_derivatives(image['id'], derivatives)
+
+
+def record_hash(db, image):
+    try:
+        phash = perceptual_hash(image['file_path'])
+    except (OSError, ValueError) as e:
+        # Still stored; it just won't show up as similar
+        logger.warning("No perceptual hash for image %s: %s", image['id'], e)
+        return
+    db.set_image_hash(image['id'], phash)
+
+
+@handler("transcode")
+def transcode_image(db, job):
+    image = db.get_image_source(job['image_id'])
+    if image is None:
+        return
+    Transcoder(db).apply(image)
+    # Cut thumbnails from the re-encoded file rather than the upload
+    make_derivatives(db, job)
+
+
+@handler("release-files")
+def release_files(db, job):
+    db.release_files(job['payload']['paths'])
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, so a bad batch doesn't retry in lockstep"""
+    delay = min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class JobWorker(threading.Thread):
+    def __init__(self, db=None, poll_interval=1.0, lease_ttl=LEASE_TTL):
+        super().__init__(name="job-worker", daemon=True)
+        self.db = db or DatabaseManager()
+        self.poll_interval = poll_interval
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        self.join(timeout)
+
+    def notify(self):
+        """Check the queue now rather than at the next poll"""
+        self._wakeup.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                ran = self.run_once()
+            except Exception:
+                logger.exception("Job queue poll failed")
+                ran = False
+            if not ran:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def run_once(self):
+        """Run one job if any is due; returns whether one ran"""
+        jobs = self.db.claim_jobs(self.owner, self.lease_ttl)
+        if not jobs:
+            return False
+        job = jobs[0]
+        try:
+            HANDLERS[job['kind']](self.db, job)
+        except Exception as e:
+            logger.warning("Job %s (%s) failed on attempt %s: %s", job['id'], job['kind'], job['attempts'], e)
+            error = "".join(traceback.format_exception_only(type(e), e)).strip()
+            self.db.fail_job(job['id'], self.owner, error, retry_delay(job['attempts']))
+        else:
+            self.db.complete_job(job['id'], self.owner)
+        return True
+
+
+def run_process(poll_interval):
+    """Entry point of one worker process"""
+    logging.basicConfig(level=logging.INFO, format="%(processName)s %(levelname)s %(message)s")
+    worker = JobWorker(poll_interval=poll_interval)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    worker.start()
+    stop.wait()
+    # Let the current job finish; an abandoned one is retried after its lease
+    worker.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process queued background jobs")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    # Create the schema once up front, then give every process its own connections
+    DatabaseManager()
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_process, args=(args.poll_interval,), name=f"worker-{i}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Children got the SIGINT too and are finishing their current job
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()